@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+import functools
+import threading
+
+# keystone is only imported once free-form assembly is actually needed,
+# the fixed instruction forms are encoded by thumb2 without it.
+keystone = None
+
+def _Keystone():
+    global keystone
+    if keystone is None:
+        import keystone as ks
+        keystone = ks
+    return keystone
+
+
+class Assembler():
+    """Process wide keystone service.
+
+    Ks instances are not thread safe, so every thread gets its own instance
+    per mode. Assembled code only depends on the source text and the mode,
+    so results are memoized in a bounded LRU cache shared by all threads.
+    arch and mode default to ARM Thumb.
+    """
+    def __init__(self, arch=None, mode=None, maxsize=1024):
+        self.arch = arch
+        self.mode = mode
+        self.local = threading.local()
+        self._cached = functools.lru_cache(maxsize=maxsize)(self._Assemble)
+
+    def _Ks(self, mode):
+        instances = getattr(self.local, 'instances', None)
+        if instances is None:
+            instances = self.local.instances = {}
+        ks = instances.get(mode)
+        if ks is None:
+            # also imports keystone if arch and mode were given explicitly
+            keystone = _Keystone()
+            arch = keystone.KS_ARCH_ARM if self.arch is None else self.arch
+            ks = instances[mode] = keystone.Ks(arch, mode)
+        return ks
+
+    def _Assemble(self, code, mode):
+        if mode is None:
+            mode = _Keystone().KS_MODE_THUMB
+        encoding, count = self._Ks(mode).asm(code)
+        return (bytes(encoding), count)
+
+    def asm(self, code, mode=None):
+        return self._cached(code, self.mode if mode is None else mode)
+
+    def stats(self):
+        info = self._cached.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'maxsize': info.maxsize}
+
+    def clear(self):
+        self._cached.cache_clear()
+
+
+ASSEMBLER = Assembler()
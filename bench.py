@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+# Benchmarks against the images in bins/, e.g.:
+#   ./bench.py run -o baseline.json
+#   ./bench.py run -o current.json -b baseline.json
+#   ./bench.py compare baseline.json current.json
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+from patcher import FirmwarePatcher, SignatureIndex, FindPattern, PatchImm, MOVW_T3_IMM, MATRIX_PATCHES
+from registry import FirmwareRegistry
+from xiaotea import XiaoTea
+from xiaotea.xiaotea import checksum
+
+# kers_min_speed and cruise_control_delay signatures
+PATTERN = [0x25, 0x68, 0x40, 0xF6, 0x16, 0x07, 0xBD, 0x42]
+MASKED_PATTERN = [0x35, 0x48, 0xB0, 0xF8, 0xF8, 0x10, 0x34, 0x4B, 0x4F, 0xF4, 0x7A, 0x70, 0x01, 0x29]
+MASK = [0xFC, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFE, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
+
+PATCHES = MATRIX_PATCHES
+
+CFW_QUERY = ('kers_min_speed=45&speed_params=on&speed_normal_kmh=31&speed_normal_phase=50000'
+             '&speed_normal_battery=30000&speed_eco_kmh=26&speed_eco_phase=40000&speed_eco_battery=20000'
+             '&brake_params=on&brake_limit=115&brake_i_min=8000&brake_i_max=50000&voltage_limit=52'
+             '&motor_start_speed=3&instant_eco_switch=on&remove_hard_speed_limit=on')
+
+
+def Measure(func, repeat):
+    # seconds per call, like timeit: calibrate the loop count first
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat, number)]
+    return {'number': number, 'repeat': repeat, 'min': min(times),
+            'median': statistics.median(times), 'max': max(times)}
+
+def Benchmarks(registry):
+    """Yields (name, version, func) for every benchmark"""
+    index = SignatureIndex()
+    for version in registry:
+        image = registry[version]
+        data = image.data
+        index.lookup(data, image.sha256)
+
+        yield 'FindPattern', version, lambda data=data: FindPattern(data, PATTERN)
+        yield 'FindPattern_masked', version, lambda data=data: FindPattern(data, MASKED_PATTERN, MASK)
+
+        ofs = FindPattern(data, PATTERN) + 2
+        buf = bytearray(data)
+        yield 'PatchImm', version, lambda buf=buf, ofs=ofs: PatchImm(buf, ofs, 4, b'\x34\x12', MOVW_T3_IMM)
+
+        # a fresh patcher per call, signatures come from the shared index
+        for method, args in PATCHES:
+            def patch(data=data, digest=image.sha256, method=method, args=args):
+                getattr(FirmwarePatcher(data, index, digest=digest), method)(*args)
+            yield 'FirmwarePatcher.' + method, version, patch
+
+        encrypted = bytes(XiaoTea().encrypt(bytearray(data)))
+        yield 'XiaoTea.encrypt', version, lambda data=data: XiaoTea().encrypt(bytearray(data))
+        yield 'XiaoTea.decrypt', version, lambda encrypted=encrypted: XiaoTea().decrypt(bytearray(encrypted))
+        yield 'checksum', version, lambda data=data: checksum(data[:len(data) & ~3])
+
+def CfwBenchmarks():
+    # the full /cfw handler with builds in this process and an empty build cache
+    os.environ.setdefault('BUILD_WORKERS', '0')
+    # no preset builds in the background of the timed ones
+    os.environ.setdefault('PRESETS_PREBUILD', '0')
+    sys.path.insert(0, os.path.join(ROOT, 'web'))
+    import app as wsgi
+    from buildcache import BuildCache
+
+    client = wsgi.app.test_client()
+    for version in wsgi.registry:
+        url = '/cfw?version={}&{}'.format(version, CFW_QUERY)
+
+        def cfw(url=url):
+            wsgi.cache = BuildCache(0)
+            r = client.get(url)
+            assert r.status_code == 200, r.data
+
+        def cfw_cached(url=url):
+            r = client.get(url)
+            assert r.status_code == 200, r.data
+
+        yield 'cfw', version, cfw
+        yield 'cfw_cached', version, cfw_cached
+
+def Run(args):
+    registry = FirmwareRegistry(os.path.join(ROOT, 'bins'))
+    versions = args.versions or list(registry)
+    results = {}
+    for benchmarks in (Benchmarks(registry), CfwBenchmarks()):
+        for name, version, func in benchmarks:
+            if version not in versions or (args.only and args.only not in name):
+                continue
+            try:
+                func()
+                result = Measure(func, args.repeat)
+            except Exception as e:
+                result = {'error': '{}: {}'.format(type(e).__name__, e)}
+            results.setdefault(name, {})[version] = result
+            if 'error' in result:
+                print('{:40} {:8} {}'.format(name, version, result['error']), file=sys.stderr)
+            else:
+                print('{:40} {:8} {:12.1f} us'.format(name, version, result['min'] * 1e6), file=sys.stderr)
+
+    return {'python': platform.python_version(), 'machine': platform.machine(),
+            'time': int(time.time()), 'results': results}
+
+def Compare(baseline, current, threshold, out=sys.stdout):
+    """Compares the per-call minimum of every benchmark present in both runs,
+    returns the list of (name, version, old, new) slower than `threshold` %."""
+    regressions = []
+    for name, versions in sorted(current['results'].items()):
+        for version, new in sorted(versions.items()):
+            old = baseline['results'].get(name, {}).get(version)
+            if not old or 'error' in old or 'error' in new:
+                continue
+            change = (new['min'] / old['min'] - 1) * 100
+            flag = ''
+            if change > threshold:
+                flag = ' REGRESSION'
+                regressions.append((name, version, old['min'], new['min']))
+            print('{:40} {:8} {:12.1f} -> {:12.1f} us {:+7.1f}%{}'.format(
+                name, version, old['min'] * 1e6, new['min'] * 1e6, change, flag), file=out)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks against the images in bins/.')
+    sub = parser.add_subparsers(dest='command')
+    run = sub.add_parser('run', help='run the benchmarks')
+    run.add_argument('-o', '--output', help='write the results as JSON to this file')
+    run.add_argument('-b', '--baseline', help='compare the results against this JSON file')
+    run.add_argument('-t', '--threshold', type=float, default=10.0, help='regression threshold in %% (default: 10)')
+    run.add_argument('-k', '--only', help='only run benchmarks whose name contains this')
+    run.add_argument('-v', '--versions', nargs='+', help='only run against these versions')
+    run.add_argument('-r', '--repeat', type=int, default=5, help='timing repetitions (default: 5)')
+    compare = sub.add_parser('compare', help='compare two result files')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('-t', '--threshold', type=float, default=10.0, help='regression threshold in %% (default: 10)')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        current = Run(args)
+        if args.output:
+            with open(args.output, 'w') as fp:
+                json.dump(current, fp, indent=1, sort_keys=True)
+        else:
+            print(json.dumps(current, indent=1, sort_keys=True))
+        baseline = args.baseline
+        out = sys.stderr
+    elif args.command == 'compare':
+        with open(args.current, 'r') as fp:
+            current = json.load(fp)
+        baseline = args.baseline
+        out = sys.stdout
+    else:
+        parser.print_help()
+        return 1
+
+    if baseline:
+        with open(baseline, 'r') as fp:
+            baseline = json.load(fp)
+        regressions = Compare(baseline, current, args.threshold, out)
+        if regressions:
+            print('{} regressions over {}%'.format(len(regressions), args.threshold), file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
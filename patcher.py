@@ -1,146 +1,780 @@
 #!/usr/bin/python3
 from binascii import hexlify
+import bisect
+import copy
+import functools
+import hashlib
+import json
+import os
 import struct
-import keystone
-from xiaotea import XiaoTea
+import threading
+import time
+import collections
+import concurrent.futures
+import csv
+import inspect
+from assembler import ASSEMBLER
+import thumb2
+from registry import FirmwareImage
+from timing import Stage
+from xiaotea import XiaoTea, EncryptionCache
 
 # https://web.eecs.umich.edu/~prabal/teaching/eecs373-f10/readings/ARMv7-M_ARM.pdf
 MOVW_T3_IMM = [*[None]*5, 11, *[None]*6, 15, 14, 13, 12, None, 10, 9, 8, *[None]*4, 7, 6, 5, 4, 3, 2, 1, 0]
 MOVS_T1_IMM = [*[None]*8, 7, 6, 5, 4, 3, 2, 1, 0]
 
+class ImmLayout():
+    """Immediate layout (e.g. MOVW_T3_IMM) compiled for PatchImm.
+
+    Bit i of the layout list is bit 15 - i % 16 of halfword i // 16 and holds
+    the immediate bit it names, None keeps the bit of the instruction.
+    The halfwords are combined into one little-endian integer, runs of
+    consecutive immediate bits are then inserted with one shift and mask each.
+    """
+    def __init__(self, signature):
+        assert len(signature) % 16 == 0, 'signature must be a multiple of 16 bits long!'
+        self.size = len(signature) // 8
+
+        # (word bit, imm bit) of every immediate bit, in word bit order
+        bits = []
+        for i in range(0, len(signature), 16):
+            for j, imm_bitofs in enumerate(reversed(signature[i:i + 16])):
+                if imm_bitofs is not None:
+                    bits.append((i + j, imm_bitofs))
+
+        self.keep = (1 << len(signature)) - 1
+        # (imm bit, mask, word bit) of every run
+        self.runs = []
+        for word_bitofs, imm_bitofs in bits:
+            self.keep &= ~(1 << word_bitofs)
+            if self.runs:
+                src, mask, dst = self.runs[-1]
+                width = mask.bit_length()
+                if src + width == imm_bitofs and dst + width == word_bitofs:
+                    self.runs[-1] = (src, (mask << 1) | 1, dst)
+                    continue
+            self.runs.append((imm_bitofs, 1, word_bitofs))
+
+    def insert(self, word, imm):
+        word &= self.keep
+        for src, mask, dst in self.runs:
+            word |= ((imm >> src) & mask) << dst
+        return word
+
+@functools.lru_cache(maxsize=None)
+def _CompileImm(signature):
+    return ImmLayout(signature)
+
+MOVW_T3 = ImmLayout(MOVW_T3_IMM)
+MOVS_T1 = ImmLayout(MOVS_T1_IMM)
+
 def PatchImm(data, ofs, size, imm, signature):
     assert size % 2 == 0, 'size must be power of 2!'
-    assert len(signature) == size * 8, 'signature must be exactly size * 8 long!'
-    imm = int.from_bytes(imm, 'little')
-    sfmt = '<' + 'H' * (size // 2)
+    if not isinstance(signature, ImmLayout):
+        signature = _CompileImm(tuple(signature))
+    assert signature.size == size, 'signature must be exactly size * 8 long!'
 
-    sigs = [signature[i:i + 16][::-1] for i in range(0, len(signature), 16)]
     orig = data[ofs:ofs+size]
-    words = struct.unpack(sfmt, orig)
-
-    patched = []
-    for i, word in enumerate(words):
-        for j in range(16):
-            imm_bitofs = sigs[i][j]
-            if imm_bitofs is None:
-                continue
-
-            imm_mask = 1 << imm_bitofs
-            word_mask = 1 << j
-
-            if imm & imm_mask:
-                word |= word_mask
-            else:
-                word &= ~word_mask
-        patched.append(word)
-
-    packed = struct.pack(sfmt, *patched)
+    word = signature.insert(int.from_bytes(orig, 'little'), int.from_bytes(imm, 'little'))
+    packed = word.to_bytes(size, 'little')
     data[ofs:ofs+size] = packed
     return (orig, packed)
 
+def PatchImms(data, sites):
+    """PatchImm for every (ofs, size, imm, signature) of sites, in order.
+    Returns the (orig, packed) pair of every site."""
+    return [PatchImm(data, ofs, size, imm, signature) for ofs, size, imm, signature in sites]
+
 class SignatureException(Exception):
     pass
 
-def FindPattern(data, signature, mask=None, start=None, maxit=None):
-    sig_len = len(signature)
-    if start is None:
-        start = 0
-    stop = len(data) - len(signature)
-    if maxit is not None:
-        stop = start + maxit
+class PatchConflictException(Exception):
+    pass
 
-    if mask:
-        assert sig_len == len(mask), 'mask must be as long as the signature!'
-        for i in range(sig_len):
-            signature[i] &= mask[i]
+class Signature():
+    """Masked byte signature compiled for fast searching.
+
+    `signature` is a list of byte values where None is a wildcard, `mask`
+    optionally selects the bits of each byte which have to match.
+    The longest run of fully fixed bytes is used as an anchor which is located
+    with bytes.find (memchr/two-way search in C), the remaining bytes are only
+    verified at the anchor hits.
+    """
+    def __init__(self, signature, mask=None):
+        if mask:
+            assert len(signature) == len(mask), 'mask must be as long as the signature!'
+        self.length = len(signature)
+
+        self.checks = []
+        fixed = []
+        for i, value in enumerate(signature):
+            m = 0 if value is None else (mask[i] if mask else 0xFF)
+            if m:
+                self.checks.append((i, value & m, m))
+            fixed.append(m == 0xFF)
+
+        # longest run of fully fixed bytes
+        best_ofs, best_len = 0, 0
+        i = 0
+        while i < self.length:
+            if not fixed[i]:
+                i += 1
+                continue
+            j = i
+            while j < self.length and fixed[j]:
+                j += 1
+            if j - i > best_len:
+                best_ofs, best_len = i, j - i
+            i = j
+
+        self.anchor_ofs = best_ofs
+        self.anchor = bytes(signature[best_ofs:best_ofs + best_len])
+        self.checks = [c for c in self.checks if not (best_ofs <= c[0] < best_ofs + best_len)]
+
+    def anchored(self, data, ofs):
+        # match() assumes the anchor has already been found at ofs
+        pos = ofs + self.anchor_ofs
+        return ofs >= 0 and data[pos:pos + len(self.anchor)] == self.anchor
+
+    def match(self, data, ofs):
+        if ofs < 0 or ofs + self.length > len(data):
+            return False
+        for i, value, m in self.checks:
+            if data[ofs + i] & m != value:
+                return False
+        return True
+
+    def window(self, data, start=None, maxit=None):
+        if start is None:
+            start = 0
+        stop = len(data) - self.length
+        if maxit is not None:
+            stop = min(start + maxit, len(data) - self.length + 1)
+        return start, stop
+
+    def finditer(self, data, start=None, maxit=None):
+        start, stop = self.window(data, start, maxit)
+        if not self.anchor:
+            for i in range(start, stop):
+                if self.match(data, i):
+                    yield i
+            return
+
+        end = stop - 1 + self.anchor_ofs + len(self.anchor)
+        pos = start + self.anchor_ofs
+        while True:
+            pos = data.find(self.anchor, pos, end)
+            if pos < 0:
+                return
+            i = pos - self.anchor_ofs
+            if self.match(data, i):
+                yield i
+            pos += 1
+
+    def find(self, data, start=None, maxit=None):
+        for i in self.finditer(data, start, maxit):
+            return i
+        raise SignatureException('Pattern not found!')
+
+@functools.lru_cache(maxsize=256)
+def _CompileSignature(signature, mask):
+    return Signature(signature, mask)
+
+def CompileSignature(signature, mask=None):
+    return _CompileSignature(tuple(signature), tuple(mask) if mask else None)
 
-    for i in range(start, stop):
-        matches = 0
+def FindPattern(data, signature, mask=None, start=None, maxit=None):
+    return CompileSignature(signature, mask).find(data, start, maxit)
+
+
+class SignatureScanner():
+    """Finds every occurrence of a set of named signatures in one go.
+
+    Signatures sharing the same anchor are grouped, so every distinct anchor
+    is located only once and all signatures of its group are verified at each
+    hit. scan() returns a dict of name -> sorted list of offsets.
+    """
+    def __init__(self, signatures):
+        self.signatures = dict(signatures)
+        self.groups = {}
+        for name, sig in self.signatures.items():
+            self.groups.setdefault(sig.anchor, []).append((name, sig))
+
+    def scan(self, data):
+        found = {name: [] for name in self.signatures}
+        for anchor, group in self.groups.items():
+            if not anchor:
+                for name, sig in group:
+                    found[name].extend(sig.finditer(data, 0, len(data)))
+                continue
 
-        while signature[matches] is None or signature[matches] == (data[i + matches] & (mask[matches] if mask else 0xFF)):
-            matches += 1
-            if matches == sig_len:
-                return i
+            pos = data.find(anchor)
+            while pos >= 0:
+                for name, sig in group:
+                    i = pos - sig.anchor_ofs
+                    if sig.match(data, i):
+                        found[name].append(i)
+                pos = data.find(anchor, pos + 1)
+
+        for offsets in found.values():
+            offsets.sort()
+        return found
+
+
+SIGNATURES = {
+    'kers_min_speed': Signature([0x25, 0x68, 0x40, 0xF6, 0x16, 0x07, 0xBD, 0x42]),
+    'speed_params_normal': Signature([0x80, 0x28, 0x00, 0xDD, 0x80, 0x20, *[None]*2, 0x68, 0x43, 0x00, 0x0C]),
+    'speed_params_eco': Signature([0x01, 0x2A, 0x44, 0xF2, 0x68, 0x21, 0x42, 0x46, 0x05, 0xD0]),
+    'brake_params': Signature([0x73, 0x29, 0x00, 0xDD, 0x73, 0x21, 0x45, 0xF2, 0xF0, 0x53, 0x59, 0x43, 0x73, 0x23, 0x91, 0xFB, 0xF3, 0xF1, None, 0x6C, 0x51, 0x1A, 0xA1, 0xF5, 0xFA, 0x51]),
+    'voltage_limit': Signature([0x40, 0xF2, 0xA5, 0x61, 0xA0, 0xF6, 0x28, 0x20, 0x88, 0x42]),
+    'motor_start_speed': Signature([0xF0, 0xB4, None, 0x4C, 0x26, 0x68, 0x40, 0xF2, 0xBD, 0x67]),
+    'motor_power_constant': Signature([0x31, 0x68, 0x2A, 0x68, 0x09, 0xB2, 0x09, 0x1B, 0x12, 0xB2, 0xD3, 0x1A, 0x4C, 0xF6, 0x77, 0x12]),
+    'motor_power_constant_2': Signature([0xD3, 0x1A, 0x4C, 0xF6, 0x77, 0x12]),
+    'motor_power_constant_3': Signature([0xC9, 0x1B, 0x4C, 0xF6, 0x77, 0x13]),
+    'instant_eco_switch': Signature([0x2C, 0xF0, 0x02, 0x0C, 0x81, 0xF8, 0x00, 0xC0, 0x01, 0x2A, 0x0A, 0xD0]),
+    'instant_eco_switch_2': Signature([0x4C, 0xF0, 0x02, 0x0C, 0x81, 0xF8, 0x00, 0xC0, 0x01, 0x2A, 0x06, 0xD1, 0x2B, 0xB9]),
+    'instant_eco_switch_3': Signature([0x85, 0xF8, 0x34, 0x60, 0x02, 0xE0, 0x0B, 0xB9]),
+    'boot_with_eco': Signature([0xB4, 0xF8, 0xEA, 0x20, 0x01, 0x2A, 0x02, 0xD1, 0x00, 0xF8, 0x34, 0x1F, 0x01, 0x72]),
+    'cruise_control_delay': Signature(
+        [0x35, 0x48, 0xB0, 0xF8, 0xF8, 0x10, 0x34, 0x4B, 0x4F, 0xF4, 0x7A, 0x70, 0x01, 0x29],
+        [0xFC, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFE, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]),
+    'cruise_control_nobeep': Signature([0xA8, 0xF8, None, 0x40, 0x88, 0xF8, 0x07, 0x60, 0x88, 0xF8, 0x10, 0x60, 0x28, 0x78, 0x88, 0xF8, 0x11, 0x00, 0x02, 0x20]),
+    'remove_hard_speed_limit': Signature([0x08, 0x60, 0x08, 0x68, 0x42, 0xF6, 0xE0, 0x62, 0x90, 0x42, None, 0xDC, 0x08, 0x68, 0xD0, 0x42]),
+    'remove_charging_mode': Signature([0x19, 0xE0, None, 0xF8, 0x12, 0x00, 0x20, 0xB1, 0x84, 0xF8, 0x3A, 0x50, 0xE0, 0x7B, 0x18, 0xB1, 0x07, 0xE0]),
+    'stay_on_locked': Signature([None, 0x49, 0x40, 0x1C, *[None]*2, 0x88, 0x42, 0x03, 0xDB, *[None]*2, 0x08, 0xB9]),
+    'bms_uart_76800': Signature([0x00, 0x21, 0x4F, 0xF4, 0xE1, 0x30, 0x00, 0x90, 0xAD, 0xF8, 0x08, 0x10, 0x0C, 0x20, 0xAD, 0xF8, 0x04, 0x10, 0xAD, 0xF8, 0x0A, 0x00, 0xAD, 0xF8, 0x06, 0x10]),
+    'bms_uart_76800_usart3': Signature([0x00, 0x48, 0x00, 0x40]),
+    'wheel_speed_const': Signature([0xB4, 0xF9, 0x1E, 0x00, 0x40, 0xF2, 0x59, 0x11, 0x48, 0x43]),
+    'russian_throttle_eco_base': Signature(
+        [0x91, 0x42, 0x01, 0xD2, 0x08, 0x46, 0x00, 0xE0, 0x10, 0x46, 0xA6, 0x4D],
+        [0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFE, 0xFF]),
+    # STRB.W  R6, [R5, #imm12], mask imm12
+    'russian_throttle_eco_addr': Signature(
+        [0x85, 0xF8, 0x34, 0x60],
+        [0xFF, 0xFF, 0x00, 0x0F]),
+    'russian_throttle': Signature([
+        0xF0, 0xB5, 0x25, 0x4A, 0x00, 0x24, 0xA2, 0xF8, 0xEC, 0x40, 0x24, 0x49, 0x4B, 0x79, 0x00, 0x2B,
+        0x3E, 0xD1, 0x23, 0x4D, 0x2F, 0x68, 0x23, 0x4E, 0x23, 0x4B, 0x00, 0x2F, 0x39, 0xDB, None, 0x64,
+        0x01, 0x24, 0x74, 0x82, 0x32, 0x38, 0x01, 0xD5, 0x00, 0x20, 0x02, 0xE0, 0x7D, 0x28, 0x00, 0xDD,
+        0x7D, 0x20, 0xB2, 0xF8, 0xEC, 0x60, 0x7D, 0x24, 0x26, 0xB1, 0xB2, 0xF8, 0xEC, 0x20, 0x01, 0x2A,
+        0x0B, 0xD0, 0x13, 0xE0, 0xD1, 0xE9, None, 0x21, 0x52, 0x1A, 0x42, 0x43, 0x92, 0xFB, 0xF4, 0xF0,
+        0x08, 0x44, 0x29, 0x68, 0x02, 0xF0, None, None, 0x08, 0xE0, 0x4A, 0x8C, 0x89, 0x8C, 0x52, 0x1A,
+        0x42, 0x43, 0x92, 0xFB, 0xF4, 0xF0, 0x40, 0x18, 0x00, 0xD5, 0x00, 0x20, 0x19, 0x68, 0x09, 0x1A,
+        0x19, 0x68, 0x01, 0xD5, 0x41, 0x1A, 0x00, 0xE0, 0x09, 0x1A, 0x4F, 0xF4, 0x96, 0x72, 0x91, 0x42,
+        0x05, 0xDD, 0x19, 0x68, 0x81, 0x42, 0x00, 0xDD, 0x52, 0x42, 0x18, 0x68, 0x10, 0x44, 0x18, 0x60,
+        0xF0, 0xBD, 0x1C, 0x60, 0x74, 0x82, 0xF0, 0xBD, *[None] * 4 * 5]),
+    'russian_throttle_2': Signature(
+        [0x07, 0xD0, 0x0B, 0xE0, 0x00, 0xEB, 0x40, 0x00, 0x40, 0x00, 0x05, 0xE0],
+        [0xFF, 0xFF, 0xFF, 0xFF, 0xFE, 0xFF, 0xFE, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]),
+}
+
+SCANNER = SignatureScanner(SIGNATURES)
+
+class SignatureIndex():
+    """Signature offsets of known images keyed by their SHA-256.
+
+    The base images never change, so their scan results are kept in memory and
+    optionally persisted as JSON to `path`. Images which are not in the index
+    are scanned live and added to it. The index is discarded when the
+    signature registry changes.
+    """
+    def __init__(self, path=None, scanner=SCANNER):
+        self.path = path
+        self.scanner = scanner
+        self.fingerprint = self._Fingerprint(scanner)
+        self.images = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def _Fingerprint(scanner):
+        h = hashlib.sha256()
+        for name, sig in sorted(scanner.signatures.items()):
+            h.update(repr((name, sig.length, sig.anchor_ofs, sig.anchor, sig.checks)).encode())
+        return h.hexdigest()
+
+    def load(self):
+        with open(self.path, 'r') as fp:
+            index = json.load(fp)
+        if index.get('fingerprint') == self.fingerprint:
+            self.images = index['images']
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump({'fingerprint': self.fingerprint, 'images': self.images}, fp, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def lookup(self, data, digest=None):
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            offsets = self.images.get(digest)
+        if offsets is not None:
+            return offsets
+
+        offsets = self.scanner.scan(data)
+        with self.lock:
+            self.images[digest] = offsets
+            self.save()
+        return offsets
+
+    def build(self, paths):
+        for path in paths:
+            with open(path, 'rb') as fp:
+                self.lookup(fp.read())
+
+    def __contains__(self, digest):
+        with self.lock:
+            return digest in self.images
+
+class SignatureHints():
+    """Expected signature offsets per firmware version, for images which
+    aren't in the SignatureIndex (i.e. would have to be scanned first).
+
+    Hints are keyed by the signature and the start of the lookup. A hint of
+    the version itself was the first match from that start, so it's only
+    verified at its offset. A hint of the closest older version only bounds
+    the search: the first match from the start up to `window` bytes past it.
+    The full scan is the fallback. Resolved offsets are remembered for the
+    next lookups, save() persists them as JSON to `path`. Counts how often
+    each tier resolves a lookup.
+    """
+    TIERS = ('exact', 'window', 'full', 'missing')
+
+    def __init__(self, path=None, window=0x800):
+        self.path = path
+        self.window = window
+        self.versions = self._Load()
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.TIERS, 0)
+
+    def _Load(self):
+        if self.path and os.path.exists(self.path):
+            with open(self.path, 'r') as fp:
+                return json.load(fp)
+        return {}
+
+    def save(self):
+        # Merged into the hints on disk, so processes sharing the file don't
+        # drop each other's offsets. Not called on the request path.
+        if not self.path:
+            return
+        with self.lock:
+            versions = self._Load()
+            for version, hints in self.versions.items():
+                versions.setdefault(version, {}).update(hints)
+            self.versions = versions
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as fp:
+                json.dump(versions, fp, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    @staticmethod
+    def Key(name, start):
+        return '{}@{}'.format(name, start)
+
+    def get(self, version, key):
+        # (offset, whether it is a hint of the version itself) or (None, False)
+        with self.lock:
+            for v in sorted((v for v in self.versions if v <= version), reverse=True):
+                if key in self.versions[v]:
+                    return self.versions[v][key], v == version
+            return None, False
+
+    def learn(self, version, key, ofs):
+        with self.lock:
+            self.versions.setdefault(version, {})[key] = ofs
+
+    def count(self, tier):
+        with self.lock:
+            self.counters[tier] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['versions'] = len(self.versions)
+        return stats
+
+class DiffCache():
+    """Bounded LRU of patch method results.
+
+    A patch method's (ofs, pre, post) triples only depend on the base image,
+    the method and its arguments, so they are keyed by exactly that. Cached
+    results are spliced into the data without searching or assembling.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'rejected': 0}
+
+    def get(self, key):
+        with self.lock:
+            ret = self.entries.get(key)
+            if ret is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return ret
+
+    def put(self, key, ret):
+        with self.lock:
+            self.entries[key] = ret
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def reject(self):
+        with self.lock:
+            self.counters['rejected'] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+        return stats
+
+class OverlayBuffer():
+    """Copy-on-write view of an immutable base image.
+
+    Writes are kept as a sorted list of non-overlapping patched ranges on top
+    of the shared base, reads combine both. Only slices with step 1 and
+    writes which keep the size are supported. The contiguous image is built
+    by tobytes() once and reused until the next write.
+    """
+    def __init__(self, base):
+        self.base = base
+        self.starts = []
+        self.chunks = []
+        self._flat = None
+
+    def __len__(self):
+        return len(self.base)
+
+    def _Slice(self, key):
+        start, stop, step = key.indices(len(self.base))
+        assert step == 1, 'only contiguous slices are supported!'
+        return start, max(start, stop)
+
+    def __getitem__(self, key):
+        if not self.starts:
+            return self.base[key]
+        if not isinstance(key, slice):
+            index = key + len(self.base) if key < 0 else key
+            i = bisect.bisect_right(self.starts, index) - 1
+            if i >= 0 and index < self.starts[i] + len(self.chunks[i]):
+                return self.chunks[i][index - self.starts[i]]
+            return self.base[key]
+
+        start, stop = self._Slice(key)
+        res = None
+        for i in range(max(bisect.bisect_right(self.starts, start) - 1, 0), len(self.starts)):
+            ofs = self.starts[i]
+            if ofs >= stop:
+                break
+            chunk = self.chunks[i]
+            lo, hi = max(ofs, start), min(ofs + len(chunk), stop)
+            if lo >= hi:
+                continue
+            if res is None:
+                res = bytearray(self.base[start:stop])
+            res[lo - start:hi - start] = chunk[lo - ofs:hi - ofs]
+        return self.base[start:stop] if res is None else bytes(res)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, slice):
+            index = key + len(self.base) if key < 0 else key
+            key, value = slice(index, index + 1), bytes([value])
+        start, stop = self._Slice(key)
+        assert len(value) == stop - start, 'writes must not change the size!'
+        if start == stop:
+            return
+
+        # merge with every patched range it overlaps or touches
+        lo = bisect.bisect_right(self.starts, start) - 1
+        if lo >= 0 and self.starts[lo] + len(self.chunks[lo]) >= start:
+            first = self.starts[lo]
+        else:
+            lo += 1
+            first = start
+        hi = bisect.bisect_right(self.starts, stop)
+        if hi == lo:
+            chunk = bytearray(value)
+        else:
+            last = max(stop, self.starts[hi - 1] + len(self.chunks[hi - 1]))
+            chunk = bytearray(self[first:last])
+            chunk[start - first:stop - first] = value
+        self.starts[lo:hi] = [first]
+        self.chunks[lo:hi] = [chunk]
+        self._flat = None
+
+    def snapshot(self):
+        # chunks are replaced on writes, never modified, copying the lists is enough
+        return self.starts[:], self.chunks[:], self._flat
+
+    def restore(self, state):
+        self.starts, self.chunks, self._flat = state
+
+    def __bytes__(self):
+        return self.tobytes()
+
+    def tobytes(self):
+        if self._flat is None:
+            if not self.chunks:
+                self._flat = self.base
+            else:
+                buf = bytearray(self.base)
+                for ofs, chunk in zip(self.starts, self.chunks):
+                    buf[ofs:ofs + len(chunk)] = chunk
+                self._flat = bytes(buf)
+        return self._flat
+
+def _FreezeDiff(ret):
+    # immutable copy of a patch method result for the DiffCache, the info
+    # dicts (e.g. of russian_throttle) are copied instead
+    return tuple(copy.deepcopy(change) if isinstance(change, dict) else (change[0], bytes(change[1]), bytes(change[2]))
+                 for change in ret)
+
+def PatchMethod(func):
+    # Records the (ofs, pre, post) triples returned by a patch method and
+    # serves it from the DiffCache of the patcher if it has one. A method
+    # which raises (e.g. PatchConflictException) leaves the image unchanged.
+    name = func.__name__
+    stage = 'patch.' + name
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with Stage(self.timer, stage):
+            ret = key = None
+            if self.diffs is not None:
+                key = (self.digest, name, args, tuple(sorted(kwargs.items())))
+                ret = self.diffs.get(key)
+                if ret is not None and not self._Splice(name, ret):
+                    self.diffs.reject()
+                    ret = None
+
+            if ret is None:
+                state = self.data.snapshot()
+                try:
+                    ret = _FreezeDiff(func(self, *args, **kwargs))
+                    self._CheckConflicts(name, ret)
+                except Exception:
+                    self.data.restore(state)
+                    raise
+                if key is not None:
+                    self.diffs.put(key, ret)
+
+            self._Record(name, ret)
+        return [copy.deepcopy(change) if isinstance(change, dict) else change for change in ret]
+    return wrapper
 
-    raise SignatureException('Pattern not found!')
+class FirmwarePatcher():
+    def __init__(self, data, index=None, encryption=None, diffs=None, digest=None, timer=None,
+                 hints=None, version=None):
+        # the base image is shared, patches only live in the overlay
+        self.base = data if isinstance(data, bytes) else bytes(data)
+        self.data = OverlayBuffer(self.base)
+        self.ks = ASSEMBLER
+        self.index = index
+        self.encryption = encryption
+        self.diffs = diffs
+        self.offsets = None
+        self.changes = []
+        self.ranges = []
+        # SHA-256 of the base image, pass it if it's known already
+        self._digest = digest
+        # optional StageTimer, times every patch method and search
+        self.timer = timer
+        # optional SignatureHints and the version of the image to use them for
+        assert hints is None or version is not None, 'hints need the version of the image!'
+        self.hints = hints
+        self.version = version
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.base).hexdigest()
+        return self._digest
+
+    def _Splice(self, name, ret):
+        # Applies cached patch triples, but only if the data still matches
+        changes = [change for change in ret if not isinstance(change, dict)]
+        for ofs, pre, post in changes:
+            if self.data[ofs:ofs+len(pre)] != pre:
+                return False
+        self._CheckConflicts(name, changes)
+        for ofs, pre, post in changes:
+            self.data[ofs:ofs+len(post)] = post
+        return True
+
+    def _CheckConflicts(self, name, ret):
+        # before anything is recorded, raises if another patch method wrote to the same bytes
+        for change in ret:
+            if isinstance(change, dict):
+                continue
+            ofs, pre, post = change
+            end = ofs + len(post)
+            for other_ofs, other_end, other in self.ranges:
+                if other != name and ofs < other_end and other_ofs < end:
+                    raise PatchConflictException('{} overlaps {} at {:#x}'.format(name, other, max(ofs, other_ofs)))
+
+    def _Record(self, name, ret):
+        for change in ret:
+            if isinstance(change, dict):
+                continue
+            ofs, pre, post = change
+            self.ranges.append((ofs, ofs + len(post), name))
+            self.changes.append(tuple(change))
+
+    def _FindSignature(self, name, start=None, maxit=None):
+        with Stage(self.timer, 'search'):
+            sig = SIGNATURES[name]
+            start, stop = sig.window(self.data, start, maxit)
+            # hints only stand in for the scan of images which aren't indexed
+            if self.hints is None or self._Indexed():
+                return self._ScanSignature(name, sig, start, stop)
+
+            key = SignatureHints.Key(name, start)
+            ofs = self._HintedSignature(sig, key, start, stop)
+            if ofs is not None:
+                return ofs
+            try:
+                ofs = self._ScanSignature(name, sig, start, stop)
+            except SignatureException:
+                self.hints.count('missing')
+                raise
+            self.hints.count('full')
+            self.hints.learn(self.version, key, ofs)
+            return ofs
+
+    def _Indexed(self):
+        # signature lookups are a bisect once the image was scanned or indexed
+        return self.offsets is not None or (self.index is not None and self.digest in self.index)
+
+    def _Verify(self, sig, ofs):
+        return sig.anchored(self.data, ofs) and sig.match(self.data, ofs)
+
+    def _HintedSignature(self, sig, key, start, stop):
+        hint, own = self.hints.get(self.version, key)
+        if hint is None:
+            return None
+        if own:
+            if start <= hint < stop and self._Verify(sig, hint):
+                self.hints.count('exact')
+                return hint
+            return None
+
+        # Another version's hint may be preceded by a match in this image,
+        # so the first match from start wins like in the full scan.
+        end = min(stop, hint + self.hints.window + 1)
+        for ofs in sig.finditer(self.base, start, max(end - start, 0)):
+            if self._Verify(sig, ofs):
+                self.hints.count('window')
+                self.hints.learn(self.version, key, ofs)
+                return ofs
+        return None
+
+    def _ScanSignature(self, name, sig, start, stop):
+        # All registered signatures are located by a single scan of the
+        # unpatched image (or taken from the index), lookups then only have to
+        # verify that the match still holds in the (possibly patched) data.
+        if self.offsets is None:
+            if self.index is not None:
+                self.offsets = self.index.lookup(self.base, self.digest)
+            else:
+                self.offsets = SCANNER.scan(self.base)
 
+        offsets = self.offsets[name]
+        for i in range(bisect.bisect_left(offsets, start), len(offsets)):
+            ofs = offsets[i]
+            if ofs >= stop:
+                break
+            # the anchor may have been patched since the scan
+            if self._Verify(sig, ofs):
+                return ofs
 
-class FirmwarePatcher():
-    def __init__(self, data):
-        self.data = bytearray(data)
-        self.ks = keystone.Ks(keystone.KS_ARCH_ARM, keystone.KS_MODE_THUMB)
+        raise SignatureException('Pattern not found!')
 
     def encrypt(self):
+        if self.encryption is not None:
+            # only re-encrypt from the first patched block onwards
+            self.data = self.encryption.lookup(self.base, self.digest).encrypt(self.data.tobytes(), self.changes)
+            return
         cry = XiaoTea()
-        self.data = cry.encrypt(self.data)
+        self.data = cry.encrypt(self.data.tobytes())
 
+    @PatchMethod
     def kers_min_speed(self, kmh):
         val = struct.pack('<H', int(kmh * 345))
-        sig = [0x25, 0x68, 0x40, 0xF6, 0x16, 0x07, 0xBD, 0x42]
-        ofs = FindPattern(self.data, sig) + 2
-        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3_IMM)
+        ofs = self._FindSignature('kers_min_speed') + 2
+        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3)
         return [(ofs, pre, post)]
 
+    @PatchMethod
     def speed_params(self, normal_kmh, normal_phase, normal_battery, eco_kmh, eco_phase, eco_battery):
         ret = []
-        sig = [0x80, 0x28, 0x00, 0xDD, 0x80, 0x20, *[None]*2, 0x68, 0x43, 0x00, 0x0C]
-        ofs = FindPattern(self.data, sig) + 8
+        ofs = self._FindSignature('speed_params_normal') + 8
         pre = self.data[ofs:ofs+4]
-        post = bytes(self.ks.asm('MOVW R2, #{:n}'.format(normal_battery))[0])
+        post = thumb2.movw(2, normal_battery)
         self.data[ofs:ofs+4] = post
         ret.append([ofs, pre, post])
         ofs += 4
 
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('B #0x2A')[0])
+        post = thumb2.b(0x2A)
         self.data[ofs:ofs+2] = post
         ret.append([ofs, pre, post])
         ofs += 2
 
-        sig = [0x01, 0x2A, 0x44, 0xF2, 0x68, 0x21, 0x42, 0x46, 0x05, 0xD0]
-        ofs = FindPattern(self.data, sig) + 2
-        pre, post = PatchImm(self.data, ofs, 4, struct.pack('<H', eco_phase), MOVW_T3_IMM)
+        ofs = self._FindSignature('speed_params_eco') + 2
+        pre, post = PatchImm(self.data, ofs, 4, struct.pack('<H', eco_phase), MOVW_T3)
         ret.append([ofs, pre, post])
         ofs += 4
 
         ofs += 10
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('NOP')[0])
+        post = thumb2.nop()
         self.data[ofs:ofs+2] = post
         ret.append([ofs, pre, post])
         ofs += 2
 
         ofs += 8
-        pre, post = PatchImm(self.data, ofs, 4, struct.pack('<H', eco_battery), MOVW_T3_IMM)
+        pre, post = PatchImm(self.data, ofs, 4, struct.pack('<H', eco_battery), MOVW_T3)
         ret.append([ofs, pre, post])
         ofs += 4
 
         ofs += 2
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('B #0x06')[0])
+        post = thumb2.b(0x06)
         self.data[ofs:ofs+2] = post
         ret.append([ofs, pre, post])
         ofs += 2
 
         ofs += 6
-        pre, post = PatchImm(self.data, ofs, 2, struct.pack('<B', eco_kmh), MOVS_T1_IMM)
+        pre, post = PatchImm(self.data, ofs, 2, struct.pack('<B', eco_kmh), MOVS_T1)
         ret.append([ofs, pre, post])
         ofs += 2
 
         ofs += 6
-        pre, post = PatchImm(self.data, ofs, 2, struct.pack('<B', normal_kmh), MOVS_T1_IMM)
+        pre, post = PatchImm(self.data, ofs, 2, struct.pack('<B', normal_kmh), MOVS_T1)
         ret.append([ofs, pre, post])
         ofs += 2
 
         ofs += 2
         pre = self.data[ofs:ofs+4]
-        post = bytes(self.ks.asm('MOVW R1, #{:n}'.format(normal_phase))[0])
+        post = thumb2.movw(1, normal_phase)
         self.data[ofs:ofs+4] = post
         ret.append([ofs, pre, post])
 
         return ret
 
     # limit: 1 - 130, min: 0 - 65k, max: min - 65k
+    @PatchMethod
     def brake_params(self, limit, min, max):
         ret = []
         limit = int(limit)
@@ -150,55 +784,54 @@ class FirmwarePatcher():
         max = int(max)
         assert max >= min and max < 65536
 
-        sig = [0x73, 0x29, 0x00, 0xDD, 0x73, 0x21, 0x45, 0xF2, 0xF0, 0x53, 0x59, 0x43, 0x73, 0x23, 0x91, 0xFB, 0xF3, 0xF1, None, 0x6C, 0x51, 0x1A, 0xA1, 0xF5, 0xFA, 0x51]
-        ofs = FindPattern(self.data, sig)
+        ofs = self._FindSignature('brake_params')
 
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('CMP R1, #{:n}'.format(limit))[0])
+        post = thumb2.cmp(1, limit)
         self.data[ofs:ofs+2] = post
         ret.append((ofs, pre, post))
         ofs += 2
 
         ofs += 2
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('MOVS R1, #{:n}'.format(limit))[0])
+        post = thumb2.movs(1, limit)
         self.data[ofs:ofs+2] = post
         ret.append((ofs, pre, post))
         ofs += 2
 
         pre = self.data[ofs:ofs+4]
-        post = bytes(self.ks.asm('MOVW R3, #{:n}'.format(max - min))[0])
+        post = thumb2.movw(3, max - min)
         self.data[ofs:ofs+4] = post
         ret.append((ofs, pre, post))
         ofs += 4
 
         ofs += 2
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('MOVS R3, #{:n}'.format(limit))[0])
+        post = thumb2.movs(3, limit)
         self.data[ofs:ofs+2] = post
         ret.append((ofs, pre, post))
         ofs += 2
 
         ofs += 8
         pre = self.data[ofs:ofs+4]
-        post = bytes(self.ks.asm('SUB.W R1, R1, #{:n}'.format(min & 0xFF00))[0])
+        post = thumb2.sub_w(1, 1, min & 0xFF00)
         self.data[ofs:ofs+4] = post
         ret.append((ofs, pre, post))
 
         return ret
 
+    @PatchMethod
     def voltage_limit(self, volts):
         val = struct.pack('<H', int(volts * 100) - 2600)
-        sig = [0x40, 0xF2, 0xA5, 0x61, 0xA0, 0xF6, 0x28, 0x20, 0x88, 0x42]
-        ofs = FindPattern(self.data, sig)
-        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3_IMM)
+        ofs = self._FindSignature('voltage_limit')
+        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3)
         return [(ofs, pre, post)]
 
+    @PatchMethod
     def motor_start_speed(self, kmh):
         val = struct.pack('<H', int(kmh * 345))
-        sig = [0xF0, 0xB4, None, 0x4C, 0x26, 0x68, 0x40, 0xF2, 0xBD, 0x67]
-        ofs = FindPattern(self.data, sig) + 6
-        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3_IMM)
+        ofs = self._FindSignature('motor_start_speed') + 6
+        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3)
         return [(ofs, pre, post)]
 
     # lower value = more power
@@ -206,159 +839,149 @@ class FirmwarePatcher():
     # DYoC = 40165 (~650 Watt)
     # CFW W = 27877 (~850 Watt)
     # CFW = 25787 (~1000 Watt)
+    @PatchMethod
     def motor_power_constant(self, val):
         val = struct.pack('<H', int(val))
-        ret = []
-        sig = [0x31, 0x68, 0x2A, 0x68, 0x09, 0xB2, 0x09, 0x1B, 0x12, 0xB2, 0xD3, 0x1A, 0x4C, 0xF6, 0x77, 0x12]
-        ofs = FindPattern(self.data, sig) + 12
-        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3_IMM)
-        ret.append((ofs, pre, post))
+        sites = []
+        ofs = self._FindSignature('motor_power_constant') + 12
+        sites.append(ofs)
         ofs += 4
 
         ofs += 4
-        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3_IMM)
-        ret.append((ofs, pre, post))
+        sites.append(ofs)
 
-        sig = [0xD3, 0x1A, 0x4C, 0xF6, 0x77, 0x12]
-        ofs = FindPattern(self.data, sig, None, ofs, 100) + 2
-        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3_IMM)
-        ret.append((ofs, pre, post))
+        ofs = self._FindSignature('motor_power_constant_2', ofs, 100) + 2
+        sites.append(ofs)
         ofs += 4
 
         ofs += 4
-        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3_IMM)
-        ret.append((ofs, pre, post))
+        sites.append(ofs)
 
-        sig = [0xC9, 0x1B, 0x4C, 0xF6, 0x77, 0x13]
-        ofs = FindPattern(self.data, sig, None, ofs, 100) + 2
-        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3_IMM)
-        ret.append((ofs, pre, post))
-        return ret
+        ofs = self._FindSignature('motor_power_constant_3', ofs, 100) + 2
+        sites.append(ofs)
 
+        patched = PatchImms(self.data, [(ofs, 4, val, MOVW_T3) for ofs in sites])
+        return [(ofs, pre, post) for ofs, (pre, post) in zip(sites, patched)]
+
+    @PatchMethod
     def instant_eco_switch(self):
         ret = []
-        sig = [0x2C, 0xF0, 0x02, 0x0C, 0x81, 0xF8, 0x00, 0xC0, 0x01, 0x2A, 0x0A, 0xD0]
-        ofs = FindPattern(self.data, sig) + 8
+        ofs = self._FindSignature('instant_eco_switch') + 8
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('NOP')[0])
+        post = thumb2.nop()
         self.data[ofs:ofs+2] = post
         ret.append((ofs, pre, post))
         ofs += 2
 
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('B #0x18')[0])
+        post = thumb2.b(0x18)
         self.data[ofs:ofs+2] = post
         ret.append((ofs, pre, post))
         ofs += 2
 
-        sig = [0x4C, 0xF0, 0x02, 0x0C, 0x81, 0xF8, 0x00, 0xC0, 0x01, 0x2A, 0x06, 0xD1, 0x2B, 0xB9]
-        ofs = FindPattern(self.data, sig, None, ofs, 100) + 8
+        ofs = self._FindSignature('instant_eco_switch_2', ofs, 100) + 8
         pre = self.data[ofs:ofs+6]
-        post = bytes(self.ks.asm('NOP;NOP;NOP')[0])
+        post = thumb2.nop() * 3
         self.data[ofs:ofs+6] = post
         ret.append((ofs, pre, post))
         ofs += 6
 
-        sig = [0x85, 0xF8, 0x34, 0x60, 0x02, 0xE0, 0x0B, 0xB9]
-        ofs = FindPattern(self.data, sig, None, ofs, 100) + 6
+        ofs = self._FindSignature('instant_eco_switch_3', ofs, 100) + 6
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('NOP')[0])
+        post = thumb2.nop()
         self.data[ofs:ofs+2] = post
         ret.append((ofs, pre, post))
         return ret
 
+    @PatchMethod
     def boot_with_eco(self):
         ret = []
-        sig = [0xB4, 0xF8, 0xEA, 0x20, 0x01, 0x2A, 0x02, 0xD1, 0x00, 0xF8, 0x34, 0x1F, 0x01, 0x72]
-        ofs = FindPattern(self.data, sig)
+        ofs = self._FindSignature('boot_with_eco')
         pre = self.data[ofs:ofs+4]
-        post = bytes(self.ks.asm('STRH.W R1, [R4, #0xEA]')[0])
+        post = thumb2.strh_w(1, 4, 0xEA)
         self.data[ofs:ofs+4] = post
         ret.append((ofs, pre, post))
         ofs += 4
 
         pre = self.data[ofs:ofs+4]
-        post = bytes(self.ks.asm('NOP;NOP')[0])
+        post = thumb2.nop() * 2
         self.data[ofs:ofs+4] = post
         ret.append((ofs, pre, post))
         return ret
 
+    @PatchMethod
     def cruise_control_delay(self, delay):
         delay = int(delay * 200)
         assert delay.bit_length() <= 12, 'bit length overflow'
-        sig = [0x35, 0x48, 0xB0, 0xF8, 0xF8, 0x10, 0x34, 0x4B, 0x4F, 0xF4, 0x7A, 0x70, 0x01, 0x29]
-        mask= [0xFC, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFE, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
-        ofs = FindPattern(self.data, sig, mask) + 8
+        ofs = self._FindSignature('cruise_control_delay') + 8
         pre = self.data[ofs:ofs+4]
-        post = bytes(self.ks.asm('MOV.W R0, #{:n}'.format(delay))[0])
+        post = thumb2.mov_w(0, delay)
         self.data[ofs:ofs+4] = post
         return [(ofs, pre, post)]
 
+    @PatchMethod
     def cruise_control_nobeep(self):
-        sig = [0xA8, 0xF8, None, 0x40, 0x88, 0xF8, 0x07, 0x60, 0x88, 0xF8, 0x10, 0x60, 0x28, 0x78, 0x88, 0xF8, 0x11, 0x00, 0x02, 0x20]
-        ofs = FindPattern(self.data, sig) + 22
+        ofs = self._FindSignature('cruise_control_nobeep') + 22
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('NOP')[0])
+        post = thumb2.nop()
         self.data[ofs:ofs+2] = post
         return [(ofs, pre, post)]
 
+    @PatchMethod
     def remove_hard_speed_limit(self):
-        sig = [0x08, 0x60, 0x08, 0x68, 0x42, 0xF6, 0xE0, 0x62, 0x90, 0x42, None, 0xDC, 0x08, 0x68, 0xD0, 0x42]
-        ofs = FindPattern(self.data, sig) + 8
+        ofs = self._FindSignature('remove_hard_speed_limit') + 8
         pre = self.data[ofs:ofs+10]
-        post = bytes(self.ks.asm('NOP;'*5)[0])
+        post = thumb2.nop() * 5
         self.data[ofs:ofs+10] = post
         return [(ofs, pre, post)]
 
+    @PatchMethod
     def remove_charging_mode(self):
-        sig = [0x19, 0xE0, None, 0xF8, 0x12, 0x00, 0x20, 0xB1, 0x84, 0xF8, 0x3A, 0x50, 0xE0, 0x7B, 0x18, 0xB1, 0x07, 0xE0]
-        ofs = FindPattern(self.data, sig) + 6
+        ofs = self._FindSignature('remove_charging_mode') + 6
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('NOP')[0])
+        post = thumb2.nop()
         self.data[ofs:ofs+2] = post
         return [(ofs, pre, post)]
 
+    @PatchMethod
     def stay_on_locked(self):
-        sig = [None, 0x49, 0x40, 0x1C, *[None]*2, 0x88, 0x42, 0x03, 0xDB, *[None]*2, 0x08, 0xB9]
-        ofs = FindPattern(self.data, sig) + 14
+        ofs = self._FindSignature('stay_on_locked') + 14
         pre = self.data[ofs:ofs+4]
-        post = bytes(self.ks.asm('NOP;NOP')[0])
+        post = thumb2.nop() * 2
         self.data[ofs:ofs+4] = post
         return [(ofs, pre, post)]
 
+    @PatchMethod
     def bms_uart_76800(self):
         ofs = 0
         while True:
-            sig = [0x00, 0x21, 0x4F, 0xF4, 0xE1, 0x30, 0x00, 0x90, 0xAD, 0xF8, 0x08, 0x10, 0x0C, 0x20, 0xAD, 0xF8, 0x04, 0x10, 0xAD, 0xF8, 0x0A, 0x00, 0xAD, 0xF8, 0x06, 0x10]
-            ofs = FindPattern(self.data, sig, None, ofs) + 2
+            ofs = self._FindSignature('bms_uart_76800', ofs) + 2
 
             # USART3 address
-            sig = [0x00, 0x48, 0x00, 0x40]
             try:
-                FindPattern(self.data, sig, None, ofs, 0x100)
+                self._FindSignature('bms_uart_76800_usart3', ofs, 0x100)
                 break
             except SignatureException:
                 continue
 
         pre = self.data[ofs:ofs+4]
-        post = bytes(self.ks.asm('MOV.W R0, #76800')[0])
+        post = thumb2.mov_w(0, 76800)
         self.data[ofs:ofs+4] = post
         return [(ofs, pre, post)]
 
+    @PatchMethod
     def wheel_speed_const(self, val):
         val = struct.pack('<H', int(val))
-        sig = [0xB4, 0xF9, 0x1E, 0x00, 0x40, 0xF2, 0x59, 0x11, 0x48, 0x43]
-        ofs = FindPattern(self.data, sig) + 4
-        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3_IMM)
+        ofs = self._FindSignature('wheel_speed_const') + 4
+        pre, post = PatchImm(self.data, ofs, 4, val, MOVW_T3)
         self.data[ofs:ofs+4] = post
         return [(ofs, pre, post)]
 
+    @PatchMethod
     def russian_throttle(self):
         ret = [dict()]
         # Find address of eco mode, part 1 find base addr
-        sig = [0x91, 0x42, 0x01, 0xD2, 0x08, 0x46, 0x00, 0xE0, 0x10, 0x46, 0xA6, 0x4D]
-        mask= [0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFE, 0xFF]
-        ofs = FindPattern(self.data, sig, mask)
+        ofs = self._FindSignature('russian_throttle_eco_base')
         ofs += 10
         imm = struct.unpack('<H', self.data[ofs:ofs + 2])[0] & 0xFF
         ofsa = ofs + imm * 4 + 4 # ZeroExtend '00' + align?
@@ -367,27 +990,16 @@ class FirmwarePatcher():
         ret[0]['eco_base'] = {'ofs': ofs, 'imm': imm, 'ofsa': ofsa, 'addr': hex(eco_addr)}
 
         # part 2, find offset of base addr
-        sig = [0x85, 0xF8, 0x34, 0x60] # STRB.W  R6, [R5, #imm12]
-        mask= [0xFF, 0xFF, 0x00, 0x0F] # mask imm12
-        ofs = FindPattern(self.data, sig, mask, ofs, 100)
+        ofs = self._FindSignature('russian_throttle_eco_addr', ofs, 100)
         imm = struct.unpack('<HH', self.data[ofs:ofs + 4])[1] & 0x0FFF
         eco_addr += imm
 
         ret[0]['eco_addr'] = {'ofs': ofs, 'imm': imm, 'addr': hex(eco_addr)}
 
-        sig = [0xF0, 0xB5, 0x25, 0x4A, 0x00, 0x24, 0xA2, 0xF8, 0xEC, 0x40, 0x24, 0x49, 0x4B, 0x79, 0x00, 0x2B,
-               0x3E, 0xD1, 0x23, 0x4D, 0x2F, 0x68, 0x23, 0x4E, 0x23, 0x4B, 0x00, 0x2F, 0x39, 0xDB, None, 0x64,
-               0x01, 0x24, 0x74, 0x82, 0x32, 0x38, 0x01, 0xD5, 0x00, 0x20, 0x02, 0xE0, 0x7D, 0x28, 0x00, 0xDD,
-               0x7D, 0x20, 0xB2, 0xF8, 0xEC, 0x60, 0x7D, 0x24, 0x26, 0xB1, 0xB2, 0xF8, 0xEC, 0x20, 0x01, 0x2A,
-               0x0B, 0xD0, 0x13, 0xE0, 0xD1, 0xE9, None, 0x21, 0x52, 0x1A, 0x42, 0x43, 0x92, 0xFB, 0xF4, 0xF0,
-               0x08, 0x44, 0x29, 0x68, 0x02, 0xF0, None, None, 0x08, 0xE0, 0x4A, 0x8C, 0x89, 0x8C, 0x52, 0x1A,
-               0x42, 0x43, 0x92, 0xFB, 0xF4, 0xF0, 0x40, 0x18, 0x00, 0xD5, 0x00, 0x20, 0x19, 0x68, 0x09, 0x1A,
-               0x19, 0x68, 0x01, 0xD5, 0x41, 0x1A, 0x00, 0xE0, 0x09, 0x1A, 0x4F, 0xF4, 0x96, 0x72, 0x91, 0x42,
-               0x05, 0xDD, 0x19, 0x68, 0x81, 0x42, 0x00, 0xDD, 0x52, 0x42, 0x18, 0x68, 0x10, 0x44, 0x18, 0x60,
-               0xF0, 0xBD, 0x1C, 0x60, 0x74, 0x82, 0xF0, 0xBD, *[None] * 4 * 5]
-        ofs = FindPattern(self.data, sig)
-
-        ofsa = ofs + len(sig) - (4 * 5)
+        sig = SIGNATURES['russian_throttle']
+        ofs = self._FindSignature('russian_throttle')
+
+        ofsa = ofs + sig.length - (4 * 5)
         addr1, addr2, addr3, addr4, addr5 = struct.unpack('<LLLLL', self.data[ofsa:ofsa + 20])
 
         # STRH.W (T2)  Rt, [Rn, #imm12]
@@ -480,38 +1092,320 @@ class FirmwarePatcher():
                 B      loc_popret
         '''
 
-        res = self.ks.asm(asm)
-        assert len(res[0]) <= len(sig), 'new code larger than old code, this won\'t work'
+        with Stage(self.timer, 'assemble'):
+            res = self.ks.asm(asm)
+        assert len(res[0]) <= sig.length, 'new code larger than old code, this won\'t work'
         assert len(res[0]) == 164, 'hardcoded size safety check, if you haven\'t changed the ASM then something is wrong'
 
         # pad with zero for no apparent reason
-        padded = bytes(res[0]).ljust(len(sig), b'\x00')
+        padded = bytes(res[0]).ljust(sig.length, b'\x00')
 
-        ret[0]['len_sig'] = len(sig)
+        ret[0]['len_sig'] = sig.length
         ret[0]['len_res'] = len(res[0])
         ret[0]['res_inst'] = res[1]
 
-        self.data[ofs:ofs+len(padded)] = bytes(padded)
+        pre = self.data[ofs:ofs+len(padded)]
+        post = bytes(padded)
+        self.data[ofs:ofs+len(padded)] = post
+        ret.append((ofs, pre, post))
 
         # additional russian change
-        sig = [0x07, 0xD0, 0x0B, 0xE0, 0x00, 0xEB, 0x40, 0x00, 0x40, 0x00, 0x05, 0xE0]
-        mask= [0xFF, 0xFF, 0xFF, 0xFF, 0xFE, 0xFF, 0xFE, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
-        ofs = FindPattern(self.data, sig, mask) + 8
+        ofs = self._FindSignature('russian_throttle_2') + 8
         pre = self.data[ofs:ofs+2]
-        post = bytes(self.ks.asm('NOP')[0])
+        post = thumb2.nop()
         self.data[ofs:ofs+2] = post
         ret.append((ofs, pre, post))
 
         return ret
 
 
+def FirmwareInfo(version, md5, md5e):
+    # info.txt shipped next to FIRM.bin / FIRM.bin.enc
+    return 'dev: M365;\nnam: {};\nenc: B;\ntyp: DRV;\nmd5: {};\nmd5e: {};\n'.format(version, md5, md5e)
+
+def _ConfigMethod(name, method):
+    func = getattr(FirmwarePatcher, method, None)
+    assert hasattr(func, '__wrapped__'), '{}: unknown patch method {}'.format(name, method)
+    return func
+
+def _ConfigArgs(value):
+    # JSON value of a patch method: list of arguments, single argument or true
+    if value is True or value is None:
+        return ()
+    if isinstance(value, list):
+        return tuple(value)
+    return (value,)
+
+def _CsvArg(value):
+    for conv in (int, float):
+        try:
+            return conv(value)
+        except ValueError:
+            pass
+    return value
+
+def LoadConfigs(path):
+    """Named patch configurations, name -> list of (method, args).
+
+    JSON: {"name": {"kers_min_speed": 45, "speed_params": [31, ...], "instant_eco_switch": true}}
+    CSV: a "name" column and one column per patch method, arguments are
+    separated by ';', methods without arguments are applied for any non-empty
+    cell and empty cells are skipped. Patches are applied in file order.
+    """
+    configs = collections.OrderedDict()
+    with open(path, 'r', newline='') as fp:
+        if path.lower().endswith('.csv'):
+            for row in csv.DictReader(fp):
+                name = row.pop('name')
+                patches = []
+                for method, value in row.items():
+                    value = (value or '').strip()
+                    if not value:
+                        continue
+                    args = ()
+                    if len(inspect.signature(_ConfigMethod(name, method)).parameters) > 1:
+                        args = tuple(_CsvArg(arg.strip()) for arg in value.split(';'))
+                    patches.append((method, args))
+                configs[name] = patches
+        else:
+            for name, methods in json.load(fp, object_pairs_hook=collections.OrderedDict).items():
+                configs[name] = [(method, _ConfigArgs(value)) for method, value in methods.items()
+                                 if value is not False and _ConfigMethod(name, method)]
+    return configs
+
+# Per worker process state of BatchBuild, set up once by the pool initializer
+_batch = None
+
+def _InitBatchWorker(images):
+    global _batch
+    index = SignatureIndex()
+    for image in images.values():
+        index.lookup(image.data, image.sha256)
+    _batch = (images, index, EncryptionCache(), DiffCache())
+
+def _BatchJob(name, version, patches, out_dir):
+    images, index, encryption, diffs = _batch
+    image = images[version]
+    patcher = FirmwarePatcher(image.data, index, encryption, diffs, image.sha256)
+    for method, args in patches:
+        getattr(patcher, method)(*args)
+
+    data = patcher.data.tobytes()
+    patcher.encrypt()
+    md5 = hashlib.md5(data).hexdigest()
+    md5e = hashlib.md5(patcher.data).hexdigest()
+
+    path = os.path.join(out_dir, name, version)
+    os.makedirs(path, exist_ok=True)
+    for filename, content in (('FIRM.bin', data), ('FIRM.bin.enc', patcher.data),
+                              ('info.txt', FirmwareInfo(version, md5, md5e).encode())):
+        with open(os.path.join(path, filename), 'wb') as fp:
+            fp.write(content)
+    return md5, md5e
+
+def BatchBuild(configs, images, out_dir, workers=None):
+    """Builds every configuration for every image on a process pool.
+
+    `images` is a dict of version -> FirmwareImage, the outputs are written to
+    out_dir/<config>/<version>/. Every worker keeps its signature index,
+    patch diffs and encrypted base images across jobs. Yields
+    (name, version, md5, md5e, error) as jobs finish.
+    """
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_InitBatchWorker,
+                                                initargs=(images,)) as executor:
+        jobs = {}
+        for name, patches in configs.items():
+            for version in images:
+                jobs[executor.submit(_BatchJob, name, version, patches, out_dir)] = (name, version)
+
+        for future in concurrent.futures.as_completed(jobs):
+            name, version = jobs[future]
+            try:
+                md5, md5e = future.result()
+            except Exception as e:
+                yield name, version, None, None, '{}: {}'.format(type(e).__name__, e)
+            else:
+                yield name, version, md5, md5e, None
+
+
+# every patch method with typical arguments, used for dry runs
+MATRIX_PATCHES = [
+    ('kers_min_speed', (45,)),
+    ('speed_params', (31, 50000, 30000, 26, 40000, 20000)),
+    ('brake_params', (115, 8000, 50000)),
+    ('voltage_limit', (52,)),
+    ('motor_start_speed', (3,)),
+    ('motor_power_constant', (40165,)),
+    ('instant_eco_switch', ()),
+    ('boot_with_eco', ()),
+    ('cruise_control_delay', (5,)),
+    ('cruise_control_nobeep', ()),
+    ('remove_hard_speed_limit', ()),
+    ('remove_charging_mode', ()),
+    ('stay_on_locked', ()),
+    ('bms_uart_76800', ()),
+    ('russian_throttle', ()),
+    ('wheel_speed_const', (315,)),
+]
+
+class _DryRunPatcher(FirmwarePatcher):
+    # records every signature lookup as (name, start, windowed, offset or None)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lookups = []
+
+    def _FindSignature(self, name, start=None, maxit=None):
+        try:
+            ofs = super()._FindSignature(name, start, maxit)
+        except SignatureException:
+            self.lookups.append((name, start or 0, maxit is not None, None))
+            raise
+        self.lookups.append((name, start or 0, maxit is not None, ofs))
+        return ofs
+
+def _MatrixImage(image, patches):
+    # one image of the matrix, every patch on a fresh overlay of the image
+    index = SignatureIndex()
+    start = time.perf_counter()
+    offsets = index.lookup(image.data, image.sha256)
+    row = {'sha256': image.sha256, 'size': image.size, 'scan_seconds': time.perf_counter() - start,
+           'patches': collections.OrderedDict(), 'hints': {}}
+
+    for method, args in patches:
+        patcher = _DryRunPatcher(image.data, index, digest=image.sha256)
+        error = None
+        start = time.perf_counter()
+        try:
+            changes = getattr(patcher, method)(*args)
+        except Exception as e:
+            changes = []
+            error = '{}: {}'.format(type(e).__name__, e)
+        seconds = time.perf_counter() - start
+
+        signatures = collections.OrderedDict()
+        for name, lookup_start, windowed, ofs in patcher.lookups:
+            if ofs is not None:
+                row['hints'].setdefault(SignatureHints.Key(name, lookup_start), ofs)
+            # candidates of the signature in the whole unpatched image
+            sig = signatures.setdefault(name, {'offsets': [], 'matches': len(offsets[name]), 'windowed': windowed})
+            if ofs is not None and ofs not in sig['offsets']:
+                sig['offsets'].append(ofs)
+        row['patches'][method] = {
+            'ok': error is None,
+            'error': error,
+            'changes': [ofs for ofs, pre, post in (c for c in changes if not isinstance(c, dict))],
+            'signatures': signatures,
+            # a signature found anywhere in the image by a lookup that matches more than once
+            'ambiguous': any(sig['matches'] > 1 and not sig['windowed'] for sig in signatures.values()),
+            'seconds': seconds,
+        }
+    return row
+
+def SignatureMatrix(images, patches=MATRIX_PATCHES, workers=None):
+    """Dry runs every patch method against every image on a process pool.
+
+    `images` is a dict of version -> FirmwareImage, every image is scanned
+    once and each patch is applied to a fresh overlay of it. Yields
+    (version, row) as images finish, see _MatrixImage for the row. row['hints']
+    are the SignatureHints of the image.
+    """
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        jobs = {executor.submit(_MatrixImage, image, patches): version for version, image in images.items()}
+        for future in concurrent.futures.as_completed(jobs):
+            yield jobs[future], future.result()
+
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 if __name__ == "__main__":
     import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        import argparse
+        parser = argparse.ArgumentParser(prog='{0} batch'.format(sys.argv[0]),
+                                         description='Build every configuration for every base image.')
+        parser.add_argument('configs', help='JSON or CSV file of named patch configurations')
+        parser.add_argument('out_dir', help='outputs are written to <out_dir>/<config>/<version>/')
+        parser.add_argument('images', nargs='+', help='base images, the version is the file name without .bin')
+        parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: all cores)')
+        args = parser.parse_args(sys.argv[2:])
+
+        configs = LoadConfigs(args.configs)
+        images = collections.OrderedDict()
+        for path in args.images:
+            with open(path, 'rb') as fp:
+                image = FirmwareImage(os.path.splitext(os.path.basename(path))[0], fp.read())
+            images[image.version] = image
+
+        failed = 0
+        for name, version, md5, md5e, error in BatchBuild(configs, images, args.out_dir, args.jobs):
+            if error:
+                failed += 1
+                eprint('{} {}: {}'.format(name, version, error))
+            else:
+                print('{} {} md5: {} md5e: {}'.format(name, version, md5, md5e))
+        eprint('{} builds, {} failed'.format(len(configs) * len(images), failed))
+        exit(1 if failed else 0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'matrix':
+        import argparse
+        parser = argparse.ArgumentParser(prog='{0} matrix'.format(sys.argv[0]),
+                                         description='Dry run every patch against every base image.')
+        parser.add_argument('images', nargs='+', help='base images or directories of them, the version is the file name without .bin')
+        parser.add_argument('-o', '--output', help='write the matrix as JSON to this file (default: stdout)')
+        parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: all cores)')
+        parser.add_argument('--hints', help='add the resolved signature offsets to this SignatureHints file, e.g. bins/hints.json')
+        args = parser.parse_args(sys.argv[2:])
+
+        paths = []
+        for path in args.images:
+            if os.path.isdir(path):
+                paths += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.bin'))
+            else:
+                paths.append(path)
+        images = collections.OrderedDict()
+        for path in paths:
+            with open(path, 'rb') as fp:
+                image = FirmwareImage(os.path.splitext(os.path.basename(path))[0], fp.read())
+            images[image.version] = image
+
+        matrix = collections.OrderedDict()
+        for version, row in SignatureMatrix(images, workers=args.jobs):
+            matrix[version] = row
+        matrix = collections.OrderedDict((version, matrix[version]) for version in sorted(matrix))
+
+        hints = SignatureHints(args.hints)
+        for version, row in matrix.items():
+            for key, ofs in row.pop('hints').items():
+                hints.learn(version, key, ofs)
+        if args.hints:
+            hints.save()
+
+        # patch x image summary: offset of the first change, ! = ambiguous, - = failed
+        versions = list(matrix)
+        eprint('{:24}'.format('') + ''.join('{:>10}'.format(v) for v in versions))
+        for method, _ in MATRIX_PATCHES:
+            cells = []
+            for version in versions:
+                patch = matrix[version]['patches'][method]
+                if not patch['ok']:
+                    cells.append('-')
+                else:
+                    cells.append('{:#x}{}'.format(patch['changes'][0] if patch['changes'] else 0,
+                                                  '!' if patch['ambiguous'] else ''))
+            eprint('{:24}'.format(method) + ''.join('{:>10}'.format(c) for c in cells))
+
+        if args.output:
+            with open(args.output, 'w') as fp:
+                json.dump(matrix, fp, indent=1)
+        else:
+            print(json.dumps(matrix, indent=1))
+        exit(0)
+
     if len(sys.argv) != 3:
         eprint("Usage: {0} <orig-firmware.bin> <target.bin>".format(sys.argv[0]))
+        eprint("       {0} batch <configs.json|configs.csv> <out-dir> <firmware.bin>... [-j N]".format(sys.argv[0]))
+        eprint("       {0} matrix <firmware.bin|dir>... [-o matrix.json] [-j N] [--hints hints.json]".format(sys.argv[0]))
         exit(1)
 
     with open(sys.argv[1], 'rb') as fp:
@@ -539,4 +1433,4 @@ if __name__ == "__main__":
     #cfw.encrypt()
 
     with open(sys.argv[2], 'wb') as fp:
-        fp.write(cfw.data)
+        fp.write(bytes(cfw.data))
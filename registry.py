@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+import os
+import hashlib
+
+
+class FirmwareImage():
+    __slots__ = ('version', 'data', 'sha256', 'size')
+
+    def __init__(self, version, data):
+        self.version = version
+        self.data = bytes(data)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.size = len(self.data)
+
+    @property
+    def label(self):
+        # DRV143 -> 1.4.3
+        digits = self.version[3:]
+        if self.version.startswith('DRV') and digits.isdigit():
+            return '.'.join(digits)
+        return self.version
+
+
+class FirmwareRegistry():
+    """Base firmware images found in a directory (<version>.bin), loaded once
+    and kept in memory as immutable bytes."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.images = {}
+        for f in os.listdir(directory):
+            if not f.endswith('.bin'):
+                continue
+            with open(os.path.join(directory, f), 'rb') as fp:
+                image = FirmwareImage(f[:-4], fp.read())
+            self.images[image.version] = image
+
+    def __contains__(self, version):
+        return version in self.images
+
+    def __getitem__(self, version):
+        return self.images[version]
+
+    def __iter__(self):
+        return iter(self.versions())
+
+    def versions(self):
+        # newest first
+        return sorted(self.images, reverse=True)
@@ -0,0 +1,133 @@
+import os
+import sys
+import tracemalloc
+import unittest
+from struct import pack, unpack
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from xiaotea import xiaotea
+from xiaotea import XiaoTea, XiaoTeaEncryptor, XiaoTeaDecryptor, CachedEncryption
+
+
+# Reference implementations, the original per word / per block algorithms
+
+def RefChecksum(data):
+    s = 0
+    for i in range(0, len(data), 4):
+        s += unpack('<L', data[i:i+4])[0]
+    return (((s >> 16) & 0xFFFF) | ((s & 0xFFFF) << 16)) ^ 0xFFFFFFFF
+
+def RefPad(data):
+    data = bytes(data)
+    if len(data) % 4:
+        data += b'\x00' * (4 - len(data) % 4)
+    if len(data) % 8 == 0:
+        data += b'\x00' * 4
+    return data + pack('<L', RefChecksum(data))
+
+def RefUnpad(data):
+    assert unpack('<L', data[-4:])[0] == RefChecksum(data[:-4]), 'checksum does not match!'
+    return data[:-4]
+
+def RefEncrypt(data):
+    data = RefPad(data)
+    iv = b'\x00' * 8
+    res = b''
+    for i in range(0, len(data), 8):
+        key = xiaotea.update_key(xiaotea.UPDKEY, i // 1024)
+        iv = xiaotea.tea_encrypt_ecb(xiaotea.xor(data[i:i+8], iv), key)
+        res += iv
+    return res
+
+def RefDecrypt(data):
+    iv = b'\x00' * 8
+    res = b''
+    for i in range(0, len(data), 8):
+        key = xiaotea.update_key(xiaotea.UPDKEY, i // 1024)
+        res += xiaotea.xor(xiaotea.tea_decrypt_ecb(data[i:i+8], key), iv)
+        iv = data[i:i+8]
+    return RefUnpad(res)
+
+
+# covers every alignment of the tail and more than one key epoch
+SIZES = [0, 1, 2, 3, 4, 5, 7, 8, 9, 12, 1019, 1020, 1024, 2051, 3000]
+# allocations of pad()/checksum() on top of their output
+SLACK = 64 << 10
+
+
+def Backends():
+    # with numpy and with the memoryview fallback
+    return [xiaotea.numpy, None] if xiaotea.numpy is not None else [None]
+
+
+class ChecksumTest(unittest.TestCase):
+    def test_pad_unpad(self):
+        for np in Backends():
+            with mock.patch.object(xiaotea, 'numpy', np):
+                for size in SIZES:
+                    data = os.urandom(size)
+                    padded = xiaotea.pad(data)
+                    self.assertEqual(bytes(padded), RefPad(data), (np, size))
+                    self.assertEqual(xiaotea.checksum(padded[:-4]), RefChecksum(padded[:-4]))
+                    self.assertEqual(bytes(xiaotea.unpad(padded)), data + b'\x00' * (len(padded) - 4 - size))
+
+    def test_unpad_mismatch(self):
+        padded = xiaotea.pad(os.urandom(100))
+        padded[0] ^= 1
+        with self.assertRaises(AssertionError):
+            xiaotea.unpad(padded)
+
+    def test_memory(self):
+        data = os.urandom(1 << 20)
+        for np in Backends():
+            with mock.patch.object(xiaotea, 'numpy', np):
+                tracemalloc.start()
+                try:
+                    padded = xiaotea.pad(data)
+                    _, peak = tracemalloc.get_traced_memory()
+                    self.assertLessEqual(peak, len(padded) + SLACK, np)
+                    tracemalloc.reset_peak()
+                    xiaotea.checksum(padded)
+                    _, peak = tracemalloc.get_traced_memory()
+                    self.assertLessEqual(peak, len(padded) + SLACK, np)
+                finally:
+                    tracemalloc.stop()
+
+
+class XiaoTeaTest(unittest.TestCase):
+    def test_encrypt_decrypt(self):
+        for np in Backends():
+            with mock.patch.object(xiaotea, 'numpy', np):
+                for size in SIZES:
+                    data = os.urandom(size)
+                    ct = XiaoTea().encrypt(data)
+                    self.assertEqual(bytes(ct), RefEncrypt(data), (np, size))
+                    self.assertEqual(bytes(XiaoTea().decrypt(ct)), RefDecrypt(ct))
+
+    def test_streaming(self):
+        data = os.urandom(3000)
+        ct = RefEncrypt(data)
+        for step in (1, 7, 8, 1000, 4096):
+            enc = XiaoTeaEncryptor()
+            res = b''.join(enc.update(data[i:i+step]) for i in range(0, len(data), step))
+            self.assertEqual(res + enc.finalize(), ct, step)
+
+            dec = XiaoTeaDecryptor()
+            res = b''.join(dec.update(ct[i:i+step]) for i in range(0, len(ct), step))
+            self.assertEqual(res + dec.finalize(), RefDecrypt(ct), step)
+
+    def test_cached_encryption(self):
+        base = os.urandom(3001)
+        cached = CachedEncryption(base)
+        patched = bytearray(base)
+        patched[2050:2054] = b'\x01\x02\x03\x04'
+        self.assertEqual(bytes(cached.encrypt(patched, [(2050, base[2050:2054], b'\x01\x02\x03\x04')])),
+                         RefEncrypt(patched))
+        # unreported changes fall back to a full encryption
+        patched[10] ^= 0xFF
+        self.assertEqual(bytes(cached.encrypt(patched, [])), RefEncrypt(patched))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# Encoders for the handful of fixed Thumb-2 instruction forms used by the patcher.
+# https://web.eecs.umich.edu/~prabal/teaching/eecs373-f10/readings/ARMv7-M_ARM.pdf
+# Output is identical to what keystone produces for the same instruction.
+import struct
+
+
+def _hw(*halfwords):
+    return struct.pack('<' + 'H' * len(halfwords), *halfwords)
+
+def _reg(r, low=False):
+    assert 0 <= r <= (7 if low else 14), 'invalid register R{}'.format(r)
+    return r
+
+def ThumbExpandImmInverse(value):
+    # Returns the 12 bit i:imm3:imm8 modified immediate for value (A5.3.2)
+    value &= 0xFFFFFFFF
+    if value < 0x100:
+        return value
+    b = value & 0xFF
+    if value == (b << 16) | b:
+        return 0x100 | b
+    if value == ((value >> 8) & 0xFF) * 0x01000100:
+        return 0x200 | (value >> 8) & 0xFF
+    if value == b * 0x01010101:
+        return 0x300 | b
+    for rot in range(8, 32):
+        v = ((value << rot) | (value >> (32 - rot))) & 0xFFFFFFFF
+        if v < 0x100 and v & 0x80:
+            return (rot << 7) | (v & 0x7F)
+    raise ValueError('{:#x} can not be encoded as modified immediate'.format(value))
+
+def _modimm(hw1, hw2, value):
+    imm12 = ThumbExpandImmInverse(value)
+    return _hw(hw1 | ((imm12 >> 11) << 10), hw2 | (((imm12 >> 8) & 7) << 12) | (imm12 & 0xFF))
+
+def nop():
+    # NOP (T1)
+    return _hw(0xBF00)
+
+def b(target):
+    # B (T2), target is relative to the instruction address
+    imm = target - 4
+    assert imm % 2 == 0, 'branch target must be halfword aligned'
+    imm >>= 1
+    if not -0x400 <= imm < 0x3FE:
+        raise ValueError('branch target {:#x} out of range'.format(target))
+    return _hw(0xE000 | (imm & 0x7FF))
+
+def movw(rd, imm):
+    # MOVW (T3)
+    assert 0 <= imm <= 0xFFFF, 'imm16 out of range'
+    _reg(rd)
+    return _hw(0xF240 | ((imm >> 11) & 1) << 10 | (imm >> 12),
+               ((imm >> 8) & 7) << 12 | rd << 8 | (imm & 0xFF))
+
+def mov_w(rd, imm):
+    # MOV.W (T2), modified immediate
+    return _modimm(0xF04F, _reg(rd) << 8, imm)
+
+def movs(rd, imm):
+    # MOVS (T1), MOVS.W (T2) if it doesn't fit
+    if rd <= 7 and 0 <= imm <= 0xFF:
+        return _hw(0x2000 | rd << 8 | imm)
+    return _modimm(0xF05F, _reg(rd) << 8, imm)
+
+def cmp(rn, imm):
+    # CMP (T1), CMP.W (T2) if it doesn't fit
+    if rn <= 7 and 0 <= imm <= 0xFF:
+        return _hw(0x2800 | rn << 8 | imm)
+    return _modimm(0xF1B0 | _reg(rn), 0x0F00, imm)
+
+def sub_w(rd, rn, imm):
+    # SUB.W (T3), modified immediate
+    return _modimm(0xF1A0 | _reg(rn), _reg(rd) << 8, imm)
+
+def strh_w(rt, rn, imm):
+    # STRH.W (T2)  Rt, [Rn, #imm12]
+    assert 0 <= imm <= 0xFFF, 'imm12 out of range'
+    return _hw(0xF8A0 | _reg(rn), _reg(rt) << 12 | imm)
@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+import collections
+import contextlib
+import time
+
+# shared no-op context for code paths which are only timed on request
+NO_STAGE = contextlib.nullcontext()
+
+
+class StageTimer():
+    """Durations of the named stages of one build, in seconds.
+
+    Stages with the same name add up, stages may be nested (e.g. the
+    signature search inside a patch method).
+    """
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def update(self, stages):
+        for name, seconds in stages.items():
+            self.add(name, seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def header(self):
+        # Server-Timing header value, durations in milliseconds
+        return ', '.join('{};dur={:.3f}'.format(name, seconds * 1000) for name, seconds in self.stages.items())
+
+def Stage(timer, name):
+    return NO_STAGE if timer is None else timer.stage(name)
@@ -3,13 +3,56 @@ import traceback
 import sys
 import os
 import time
-import io
-import zipfile
 import hashlib
-sys.path.append('..')
-from patcher import FirmwarePatcher
+import threading
+import collections
+import urllib.parse
+import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from buildcache import BuildCache
+from backend import BuildBackend, BackendBusy
+from builder import BUILD_FORMAT
+from registry import FirmwareRegistry
+from metrics import StageMetrics
+from presets import PRESETS, PRESET_LABELS, PRESET_FIELDS, PresetStore
+from timing import StageTimer, Stage
 
 app = flask.Flask(__name__)
+app.config.setdefault('BUILD_CACHE_BYTES', int(os.environ.get('BUILD_CACHE_BYTES', 64 << 20)))
+app.config.setdefault('BUILD_CACHE_DIR', os.environ.get('BUILD_CACHE_DIR'))
+app.config.setdefault('BUILD_CACHE_DISK_BYTES', int(os.environ.get('BUILD_CACHE_DISK_BYTES', 256 << 20)))
+app.config.setdefault('BUILD_WORKERS', int(os.environ.get('BUILD_WORKERS', os.cpu_count() or 1)))
+app.config.setdefault('BUILD_QUEUE', int(os.environ.get('BUILD_QUEUE', 64)))
+app.config.setdefault('BUILD_TIMEOUT', float(os.environ.get('BUILD_TIMEOUT', 30)))
+# build every preset for every version in the background on startup
+app.config.setdefault('PRESETS_PREBUILD', os.environ.get('PRESETS_PREBUILD', '1') not in ('', '0'))
+# how long proxies and browsers may reuse a /cfw download without revalidating
+app.config.setdefault('CFW_MAX_AGE', int(os.environ.get('CFW_MAX_AGE', 86400)))
+# per stage timing of /cfw requests for Server-Timing and /metrics
+app.config.setdefault('BUILD_TIMING', os.environ.get('BUILD_TIMING', '0') not in ('', '0'))
+
+BINS_DIR = os.path.join(app.root_path, '..', 'bins')
+registry = FirmwareRegistry(BINS_DIR)
+# recommended version, preselected in the form
+DEFAULT_VERSION = 'DRV138' if 'DRV138' in registry else registry.versions()[0]
+cache = BuildCache(app.config['BUILD_CACHE_BYTES'], app.config['BUILD_CACHE_DIR'],
+                   app.config['BUILD_CACHE_DISK_BYTES'])
+metrics = StageMetrics()
+presets = PresetStore()
+backend = None
+backend_lock = threading.Lock()
+
+def get_backend():
+    # Created on first use: spawned build workers import this module again
+    # and must not start a pool (or preset builds) of their own.
+    global backend
+    with backend_lock:
+        if backend is None:
+            backend = BuildBackend(registry, app.config['BUILD_WORKERS'],
+                                   app.config['BUILD_QUEUE'], app.config['BUILD_TIMEOUT'])
+            if app.config['PRESETS_PREBUILD']:
+                presets.prebuild(preset_builds.items(), backend.build)
+    return backend
 
 
 @app.errorhandler(Exception)
@@ -17,6 +60,11 @@ def handle_bad_request(e):
     return 'Exception occured:\n{}'.format(traceback.format_exc()), \
             400, {'Content-Type': 'text/plain'}
 
+@app.errorhandler(BackendBusy)
+def handle_busy(e):
+    return 'Server busy: {}, try again later.'.format(e), \
+            503, {'Content-Type': 'text/plain', 'Retry-After': '10'}
+
 # http://flask.pocoo.org/snippets/40/
 @app.context_processor
 def override_url_for():
@@ -34,135 +82,277 @@ def dated_url_for(endpoint, **values):
 
 @app.route('/')
 def home():
-    return flask.render_template('home.html')
-
-@app.route('/cfw')
-def patch_firmware():
-    version = flask.request.args.get('version', None)
-    if version not in ['DRV130', 'DRV134', 'DRV138', 'DRV140', 'DRV141', 'DRV142', 'DRV143']:
-        return 'Invalid firmware version.', 400
+    images = [registry[version] for version in registry]
+    return flask.render_template('home.html', images=images, default_version=DEFAULT_VERSION,
+                                 presets=PRESETS, preset_labels=PRESET_LABELS, preset_fields=PRESET_FIELDS)
 
-    with open('../bins/{}.bin'.format(version), 'rb') as fp:
-        patcher = FirmwarePatcher(fp.read())
+def parse_args(args):
+    """Validates the query parameters and returns the list of
+    (FirmwarePatcher method, arguments) to apply, in a fixed order."""
+    patches = []
 
-    kers_min_speed = flask.request.args.get('kers_min_speed', None)
+    kers_min_speed = args.get('kers_min_speed', None)
     if kers_min_speed is not None:
         kers_min_speed = float(kers_min_speed)
         assert kers_min_speed >= 0 and kers_min_speed <= 100
-        patcher.kers_min_speed(kers_min_speed)
+        patches.append(('kers_min_speed', (kers_min_speed,)))
 
-    speed_params = flask.request.args.get('speed_params', None)
+    speed_params = args.get('speed_params', None)
     if speed_params:
-        speed_normal_kmh = int(flask.request.args.get('speed_normal_kmh', None))
+        speed_normal_kmh = int(args.get('speed_normal_kmh', None))
         assert speed_normal_kmh >= 0 and speed_normal_kmh <= 100
-        speed_normal_phase = int(flask.request.args.get('speed_normal_phase', None))
+        speed_normal_phase = int(args.get('speed_normal_phase', None))
         assert speed_normal_phase >= 0 and speed_normal_phase <= 65535
-        speed_normal_battery = int(flask.request.args.get('speed_normal_battery', None))
+        speed_normal_battery = int(args.get('speed_normal_battery', None))
         assert speed_normal_battery >= 0 and speed_normal_battery <= 65535
-        speed_eco_kmh = int(flask.request.args.get('speed_eco_kmh', None))
+        speed_eco_kmh = int(args.get('speed_eco_kmh', None))
         assert speed_eco_kmh >= 0 and speed_eco_kmh <= 100
-        speed_eco_phase = int(flask.request.args.get('speed_eco_phase', None))
+        speed_eco_phase = int(args.get('speed_eco_phase', None))
         assert speed_eco_phase >= 0 and speed_eco_phase <= 65535
-        speed_eco_battery = int(flask.request.args.get('speed_eco_battery', None))
+        speed_eco_battery = int(args.get('speed_eco_battery', None))
         assert speed_eco_battery >= 0 and speed_eco_battery <= 65535
-        patcher.speed_params(speed_normal_kmh, speed_normal_phase, speed_normal_battery, speed_eco_kmh, speed_eco_phase, speed_eco_battery)
+        patches.append(('speed_params', (speed_normal_kmh, speed_normal_phase, speed_normal_battery, speed_eco_kmh, speed_eco_phase, speed_eco_battery)))
 
-    brake_params = flask.request.args.get('brake_params', None)
+    brake_params = args.get('brake_params', None)
     if brake_params:
-        brake_limit = int(flask.request.args.get('brake_limit', None))
+        brake_limit = int(args.get('brake_limit', None))
         assert brake_limit >= 1 and brake_limit <= 130
-        brake_i_min = int(flask.request.args.get('brake_i_min', None))
+        brake_i_min = int(args.get('brake_i_min', None))
         assert brake_i_min >= 0 and brake_i_min <= 65535
-        brake_i_max = int(flask.request.args.get('brake_i_max', None))
+        brake_i_max = int(args.get('brake_i_max', None))
         assert brake_i_max >= brake_i_min and brake_i_max <= 65535
-        patcher.brake_params(brake_limit, brake_i_min, brake_i_max)
+        patches.append(('brake_params', (brake_limit, brake_i_min, brake_i_max)))
 
-    motor_start_speed = flask.request.args.get('motor_start_speed', None)
+    motor_start_speed = args.get('motor_start_speed', None)
     if motor_start_speed is not None:
         motor_start_speed = float(motor_start_speed)
         assert motor_start_speed >= 0 and motor_start_speed <= 100
-        patcher.motor_start_speed(motor_start_speed)
+        patches.append(('motor_start_speed', (motor_start_speed,)))
 
-    cruise_control_delay = flask.request.args.get('cruise_control_delay', None)
+    cruise_control_delay = args.get('cruise_control_delay', None)
     if cruise_control_delay is not None:
         cruise_control_delay = float(cruise_control_delay)
         assert cruise_control_delay >= 0.1 and cruise_control_delay <= 20.0
-        patcher.cruise_control_delay(cruise_control_delay)
+        patches.append(('cruise_control_delay', (cruise_control_delay,)))
 
-    cruise_control_nobeep = flask.request.args.get('cruise_control_nobeep', None)
+    cruise_control_nobeep = args.get('cruise_control_nobeep', None)
     if cruise_control_nobeep:
-        patcher.cruise_control_nobeep()
+        patches.append(('cruise_control_nobeep', ()))
 
-    instant_eco_switch = flask.request.args.get('instant_eco_switch', None)
+    instant_eco_switch = args.get('instant_eco_switch', None)
     if instant_eco_switch:
-        patcher.instant_eco_switch()
+        patches.append(('instant_eco_switch', ()))
 
-    boot_with_eco = flask.request.args.get('boot_with_eco', None)
+    boot_with_eco = args.get('boot_with_eco', None)
     if boot_with_eco:
-        patcher.boot_with_eco()
+        patches.append(('boot_with_eco', ()))
 
-    voltage_limit = flask.request.args.get('voltage_limit', None)
+    voltage_limit = args.get('voltage_limit', None)
     if voltage_limit is not None:
         voltage_limit = float(voltage_limit)
         assert voltage_limit >= 43.01 and voltage_limit <= 100.00
-        patcher.voltage_limit(voltage_limit)
+        patches.append(('voltage_limit', (voltage_limit,)))
 
-    russian_throttle = flask.request.args.get('russian_throttle', None)
+    russian_throttle = args.get('russian_throttle', None)
     if russian_throttle:
-        patcher.russian_throttle()
+        patches.append(('russian_throttle', ()))
 
-    remove_hard_speed_limit = flask.request.args.get('remove_hard_speed_limit', None)
+    remove_hard_speed_limit = args.get('remove_hard_speed_limit', None)
     if remove_hard_speed_limit:
-        patcher.remove_hard_speed_limit()
+        patches.append(('remove_hard_speed_limit', ()))
 
-    remove_charging_mode = flask.request.args.get('remove_charging_mode', None)
+    remove_charging_mode = args.get('remove_charging_mode', None)
     if remove_charging_mode:
-        patcher.remove_charging_mode()
+        patches.append(('remove_charging_mode', ()))
 
-    stay_on_locked = flask.request.args.get('stay_on_locked', None)
+    stay_on_locked = args.get('stay_on_locked', None)
     if stay_on_locked:
-        patcher.stay_on_locked()
+        patches.append(('stay_on_locked', ()))
 
-    bms_uart_76800 = flask.request.args.get('bms_uart_76800', None)
+    bms_uart_76800 = args.get('bms_uart_76800', None)
     if bms_uart_76800:
-        patcher.bms_uart_76800()
+        patches.append(('bms_uart_76800', ()))
 
-    wheel_speed_const = flask.request.args.get('wheel_speed_const', None)
+    wheel_speed_const = args.get('wheel_speed_const', None)
     if wheel_speed_const:
         wheel_speed_const = int(wheel_speed_const)
         assert wheel_speed_const >= 200 and wheel_speed_const <= 500
-        patcher.wheel_speed_const(wheel_speed_const)
-
-    # make zip file for firmware
-    zip_buffer = io.BytesIO()
-    zip_file = zipfile.ZipFile(zip_buffer, 'a', zipfile.ZIP_DEFLATED, False)
+        patches.append(('wheel_speed_const', (wheel_speed_const,)))
+
+    return patches
+
+# Float parameters only matter as far as the patch methods quantize them
+# (int(value * scale))
+QUANTIZE = {
+    'kers_min_speed': 345,
+    'motor_start_speed': 345,
+    'cruise_control_delay': 200,
+    'voltage_limit': 100,
+}
+
+# Query parameters of the patch method arguments, methods listed here are
+# switched on with <method>=on, all others take their single argument
+# under their own name or are flags
+ARG_PARAMS = {
+    'speed_params': ('speed_normal_kmh', 'speed_normal_phase', 'speed_normal_battery',
+                     'speed_eco_kmh', 'speed_eco_phase', 'speed_eco_battery'),
+    'brake_params': ('brake_limit', 'brake_i_min', 'brake_i_max'),
+}
+
+def dequantize(scale, value):
+    # shortest decimal which quantizes like value
+    q = int(value * scale)
+    mid = (q + 0.5) / scale
+    for digits in range(17):
+        for value in (round(q / scale, digits), round(mid, digits)):
+            if int(value * scale) == q:
+                return value
+    return mid
+
+def normalize_patches(patches):
+    return [(name, tuple(dequantize(QUANTIZE[name], arg) for arg in args) if name in QUANTIZE else args)
+            for name, args in patches]
+
+def canonical_query(version, patches):
+    params = [('version', version)]
+    for name, args in patches:
+        if name in ARG_PARAMS:
+            params.append((name, 'on'))
+            params.extend(zip(ARG_PARAMS[name], args))
+        else:
+            params.append((name, args[0] if args else 'on'))
+    return urllib.parse.urlencode(params)
+
+def build_key(version, patches, url_root=''):
+    # a replaced base image or a new build format must not match old ETags
+    canonical = [BUILD_FORMAT, registry[version].sha256, url_root, version]
+    for name, args in patches:
+        if name in QUANTIZE:
+            args = tuple(int(arg * QUANTIZE[name]) for arg in args)
+        canonical.append((name, args))
+    return hashlib.sha256(repr(canonical).encode()).hexdigest()
+
+def canonical_build(version, patches, url_root):
+    """Normalized patches, build key and zip comment of a build.
+
+    Builds with the same key produce the same zip byte for byte, the key
+    doubles as the ETag of /cfw.
+    """
+    patches = normalize_patches(patches)
+    comment = '{}cfw?{}'.format(url_root, canonical_query(version, patches))
+    return patches, build_key(version, patches, url_root), comment.encode()
+
+def preset_build(name, version):
+    # presets are built without URL root, so they serve every host
+    args = dict(PRESETS[name], version=version)
+    return canonical_build(version, parse_args(args), '')
+
+def all_preset_builds():
+    # build key -> (version, patches, comment) of every preset for every version
+    builds = collections.OrderedDict()
+    for name in PRESETS:
+        for version in registry:
+            patches, key, comment = preset_build(name, version)
+            builds[key] = (version, patches, comment)
+    return builds
+
+preset_builds = all_preset_builds()
+
+def find_preset(version, patches):
+    # key and build arguments of the preset matching a /cfw build, if any
+    key = build_key(version, patches)
+    return key, preset_builds.get(key)
+
+def preset_content(key, build, timer=None):
+    # presets always come from the preset build, prebuilt or not, so their
+    # bytes (and zip comment) don't depend on the host or on timing
+    content = presets.get(key)
+    if content is None:
+        content = get_backend().build(*build, timer)
+        presets.put(key, content)
+    return content
+
+def cache_headers(key):
+    return {'ETag': '"{}"'.format(key),
+            'Cache-Control': 'public, max-age={}'.format(app.config['CFW_MAX_AGE'])}
+
+def new_timer():
+    return StageTimer() if app.config['BUILD_TIMING'] else None
+
+def record_timing(timer, start):
+    # adds the request to /metrics and returns its Server-Timing header
+    timer.add('total', time.perf_counter() - start)
+    metrics.observe(timer.stages)
+    return timer.header()
+
+
+def zip_response(content, key, filename):
+    resp = flask.Response(content)
+    resp.headers['Content-Type'] = 'application/zip'
+    resp.headers['Content-Disposition'] = 'inline; filename="{0}"'.format(filename)
+    resp.headers['Content-Length'] = len(content)
+    resp.headers.update(cache_headers(key))
+    return resp
 
-    zip_file.writestr('FIRM.bin', patcher.data)
-    md5 = hashlib.md5()
-    md5.update(patcher.data)
 
-    patcher.encrypt()
-    zip_file.writestr('FIRM.bin.enc', patcher.data)
-    md5e = hashlib.md5()
-    md5e.update(patcher.data)
+@app.route('/stats')
+def stats():
+    return flask.jsonify(build_cache=cache.stats(), backend=get_backend().stats(), presets=presets.stats())
 
-    info_txt = 'dev: M365;\nnam: {};\nenc: B;\ntyp: DRV;\nmd5: {};\nmd5e: {};\n'.format(
-        version, md5.hexdigest(), md5e.hexdigest())
+@app.route('/metrics')
+def prometheus_metrics():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
-    zip_file.writestr('info.txt', info_txt.encode())
-    zip_file.comment = flask.request.url.encode()
-    zip_file.close()
-    zip_buffer.seek(0)
-    content = zip_buffer.getvalue()
-    zip_buffer.close()
+@app.route('/cfw')
+def patch_firmware():
+    start = time.perf_counter()
+    timer = new_timer()
+    version = flask.request.args.get('version', None)
+    if version not in registry:
+        return 'Invalid firmware version.', 400
 
-    resp = flask.Response(content)
-    filename = version + '-' + str(int(time.time())) + '.zip'
-    resp.headers['Content-Type'] = 'application/zip'
-    resp.headers['Content-Disposition'] = 'inline; filename="{0}"'.format(filename)
-    resp.headers['Content-Length'] = len(content)
+    patches, key, comment = canonical_build(version, parse_args(flask.request.args), flask.request.url_root)
+    preset_key, preset = find_preset(version, patches)
+    if preset is not None:
+        key = preset_key
+    if flask.request.if_none_match.contains(key):
+        return '', 304, cache_headers(key)
+
+    content = None
+    if preset is not None:
+        content = preset_content(key, preset, timer)
+    else:
+        with Stage(timer, 'cache'):
+            content = cache.get(key)
+    if content is None:
+        content = get_backend().build(version, patches, comment, timer)
+        with Stage(timer, 'cache'):
+            cache.put(key, content)
+
+    resp = zip_response(content, key, version + '-' + str(int(time.time())) + '.zip')
+    if timer is not None:
+        resp.headers['Server-Timing'] = record_timing(timer, start)
 
     return resp
 
+@app.route('/preset/<name>/<version>')
+def preset_firmware(name, version):
+    if name not in PRESETS or version not in registry:
+        return 'Unknown preset or firmware version.', 404
+
+    patches, key, comment = preset_build(name, version)
+    if flask.request.if_none_match.contains(key):
+        return '', 304, cache_headers(key)
+
+    content = preset_content(key, (version, patches, comment))
+    return zip_response(content, key, '{}-{}.zip'.format(version, name))
+
+# Start the workers and preset builds with the app, not on the first request,
+# under any server. Build workers import this module again when it's the main
+# script, they are named after their process (parent_process() isn't set yet).
+if app.config['PRESETS_PREBUILD'] and multiprocessing.current_process().name == 'MainProcess':
+    get_backend()
+
 if __name__ == '__main__':
+    get_backend()
     app.run('0.0.0.0')
@@ -0,0 +1,208 @@
+# ASGI variant of app.py with the same routes and query parameters,
+# run it with any ASGI server from this directory, e.g.:
+#   uvicorn asgi:application
+import os
+import json
+import time
+import asyncio
+import mimetypes
+import traceback
+import concurrent.futures
+import urllib.parse
+import app as wsgi
+from werkzeug.http import parse_etags
+from backend import BackendBusy
+from timing import Stage
+
+MAX_BUILDS = int(os.environ.get('ASGI_MAX_BUILDS', wsgi.app.config['BUILD_WORKERS'] or 1))
+MAX_QUEUE = int(os.environ.get('ASGI_MAX_QUEUE', wsgi.app.config['BUILD_QUEUE']))
+CHUNK_SIZE = 64 * 1024
+
+
+class AdmissionControl():
+    """Admits at most `concurrency` builds at once and lets at most
+    `max_queue` more wait for a slot, tracking wait and build times."""
+    def __init__(self, concurrency, max_queue):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.semaphore = None
+        self.waiting = 0
+        self.running = 0
+        self.counters = {'admitted': 0, 'rejected': 0}
+        self.timings = {'wait': [0, 0.0, 0.0], 'build': [0, 0.0, 0.0]}
+        self.executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+
+    def _Time(self, name, seconds):
+        timing = self.timings[name]
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+    async def run(self, func, *args):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        if self.waiting >= self.max_queue:
+            self.counters['rejected'] += 1
+            raise BackendBusy('Too many pending builds')
+
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self._Time('wait', time.perf_counter() - start)
+
+        self.counters['admitted'] += 1
+        self.running += 1
+        start = time.perf_counter()
+        try:
+            # builds block, keep them off the event loop
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self._Time('build', time.perf_counter() - start)
+            self.running -= 1
+            self.semaphore.release()
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update(queue_depth=self.waiting, running=self.running,
+                     max_builds=self.concurrency, max_queue=self.max_queue)
+        for name, (count, total, peak) in self.timings.items():
+            stats[name + '_time'] = {'count': count, 'avg': total / count if count else 0.0, 'max': peak}
+        return stats
+
+admission = AdmissionControl(MAX_BUILDS, MAX_QUEUE)
+
+
+async def send_response(send, status, body, headers=()):
+    if isinstance(body, str):
+        body = body.encode()
+    # ASGI requires lowercase header names
+    headers = [(k.lower().encode(), str(v).encode()) for k, v in headers]
+    headers.append((b'content-length', str(len(body)).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    # a slow client only holds up this coroutine, not a build slot
+    view = memoryview(body)
+    for i in range(0, len(body), CHUNK_SIZE):
+        await send({'type': 'http.response.body', 'body': bytes(view[i:i + CHUNK_SIZE]), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+def url_root(scope):
+    headers = dict(scope.get('headers', []))
+    host = headers.get(b'host', b'localhost').decode()
+    return '{}://{}{}/'.format(scope.get('scheme', 'http'), host, scope.get('root_path', ''))
+
+def not_modified(scope, key):
+    etags = dict(scope.get('headers', [])).get(b'if-none-match')
+    return etags is not None and parse_etags(etags.decode('latin-1')).contains(key)
+
+def zip_headers(key, filename):
+    headers = [('Content-Type', 'application/zip'),
+               ('Content-Disposition', 'inline; filename="{0}"'.format(filename))]
+    headers.extend(wsgi.cache_headers(key).items())
+    return headers
+
+def home():
+    with wsgi.app.test_request_context('/'):
+        return wsgi.home()
+
+def static_path(path):
+    return os.path.join(wsgi.app.root_path, 'static', os.path.basename(path))
+
+async def preset_content(key, build, timer=None):
+    # like wsgi.preset_content, builds which weren't prebuilt (yet) are admitted
+    content = wsgi.presets.get(key)
+    if content is None:
+        content = await admission.run(wsgi.get_backend().build, *build, timer)
+        wsgi.presets.put(key, content)
+    return content
+
+async def patch_firmware(scope):
+    start = time.perf_counter()
+    timer = wsgi.new_timer()
+    # blank values are kept, they fail validation like in the WSGI app
+    args = {k: v[0] for k, v in urllib.parse.parse_qs(scope['query_string'].decode(), keep_blank_values=True).items()}
+    version = args.get('version', None)
+    if version not in wsgi.registry:
+        return 400, 'Invalid firmware version.', [('Content-Type', 'text/html; charset=utf-8')]
+
+    patches, key, comment = wsgi.canonical_build(version, wsgi.parse_args(args), url_root(scope))
+    preset_key, preset = wsgi.find_preset(version, patches)
+    if preset is not None:
+        key = preset_key
+    if not_modified(scope, key):
+        return 304, b'', list(wsgi.cache_headers(key).items())
+
+    if preset is not None:
+        content = await preset_content(key, preset, timer)
+    else:
+        with Stage(timer, 'cache'):
+            content = wsgi.cache.get(key)
+    if content is None:
+        backend = wsgi.get_backend()
+        content = await admission.run(backend.build, version, patches, comment, timer)
+        with Stage(timer, 'cache'):
+            wsgi.cache.put(key, content)
+
+    headers = zip_headers(key, version + '-' + str(int(time.time())) + '.zip')
+    if timer is not None:
+        headers.append(('Server-Timing', wsgi.record_timing(timer, start)))
+    return 200, content, headers
+
+async def preset_firmware(scope):
+    # /preset/<name>/<version>
+    parts = scope['path'].split('/')
+    name, version = parts[2], parts[3] if len(parts) == 4 else None
+    if name not in wsgi.PRESETS or version not in wsgi.registry:
+        return 404, 'Unknown preset or firmware version.', [('Content-Type', 'text/plain')]
+
+    patches, key, comment = wsgi.preset_build(name, version)
+    if not_modified(scope, key):
+        return 304, b'', list(wsgi.cache_headers(key).items())
+
+    content = await preset_content(key, (version, patches, comment))
+    return 200, content, zip_headers(key, '{}-{}.zip'.format(version, name))
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await asyncio.get_running_loop().run_in_executor(None, wsgi.get_backend)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if wsgi.backend is not None:
+                    wsgi.backend.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    path = scope['path']
+    try:
+        if path == '/':
+            await send_response(send, 200, home(), [('Content-Type', 'text/html; charset=utf-8')])
+        elif path == '/cfw':
+            status, body, headers = await patch_firmware(scope)
+            await send_response(send, status, body, headers)
+        elif path.startswith('/preset/'):
+            status, body, headers = await preset_firmware(scope)
+            await send_response(send, status, body, headers)
+        elif path == '/stats':
+            body = json.dumps({'build_cache': wsgi.cache.stats(), 'backend': wsgi.get_backend().stats(),
+                               'presets': wsgi.presets.stats(), 'admission': admission.stats()})
+            await send_response(send, 200, body, [('Content-Type', 'application/json')])
+        elif path == '/metrics':
+            await send_response(send, 200, wsgi.metrics.render(), [('Content-Type', 'text/plain; version=0.0.4')])
+        elif path.startswith('/static/') and os.path.isfile(static_path(path)):
+            with open(static_path(path), 'rb') as fp:
+                body = fp.read()
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            await send_response(send, 200, body, [('Content-Type', content_type)])
+        else:
+            await send_response(send, 404, 'Not Found', [('Content-Type', 'text/plain')])
+    except BackendBusy as e:
+        await send_response(send, 503, 'Server busy: {}, try again later.'.format(e),
+                            [('Content-Type', 'text/plain'), ('Retry-After', '10')])
+    except Exception:
+        await send_response(send, 400, 'Exception occured:\n{}'.format(traceback.format_exc()),
+                            [('Content-Type', 'text/plain')])
@@ -0,0 +1,203 @@
+import itertools
+import threading
+import time
+import weakref
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from builder import Builder
+from registry import FirmwareRegistry
+from timing import StageTimer
+
+
+class BackendBusy(Exception):
+    pass
+
+
+# Per worker process state, set up once by the pool initializer
+_builder = None
+_running = None
+
+def _InitWorker(bins_dir, running):
+    global _builder, _running
+    _builder = Builder(FirmwareRegistry(bins_dir))
+    with running.lock:
+        slot = running.next_slot.value % len(running.jobs)
+        running.next_slot.value += 1
+    _running = (running, slot)
+
+def _Build(job, version, patches, comment, timed=False):
+    running, slot = _running
+    # published for the hung worker check, the queue wait doesn't count
+    running.started[slot] = time.monotonic()
+    running.jobs[slot] = job
+    try:
+        if not timed:
+            return _builder.build(version, patches, comment), None
+        timer = StageTimer()
+        start = time.perf_counter()
+        content = _builder.build(version, patches, comment, timer)
+        timer.add('build', time.perf_counter() - start)
+        return content, timer.stages
+    finally:
+        running.jobs[slot] = 0
+
+def _Ping():
+    return None
+
+
+class _RunningJobs():
+    """Shared with the workers of one pool: the job each worker runs and since when."""
+    def __init__(self, context, workers):
+        self.lock = context.Lock()
+        self.next_slot = context.Value('i', 0, lock=False)
+        self.jobs = context.Array('q', workers, lock=False)
+        self.started = context.Array('d', workers, lock=False)
+
+    def started_at(self, job):
+        for slot, running in enumerate(self.jobs):
+            if running == job:
+                return self.started[slot]
+        return None
+
+
+class BuildBackend():
+    """Runs builds on a pool of warm worker processes.
+
+    Every worker loads the base images, signature index and caches once,
+    builds without workers use the given FirmwareRegistry.
+    At most `max_queue` builds may be pending, further submissions raise
+    BackendBusy instead of piling up. A job which doesn't finish within
+    `timeout` seconds raises BackendBusy too and is cancelled. If it was
+    already handed to the pool it's watched instead, only once it has run
+    in its worker for longer than `timeout` the pool is replaced to get rid
+    of the hung worker.
+    A crashed worker pool is replaced as well. With workers=0 builds run in the calling thread.
+    build() records the stages of the build in `timer` if one is given.
+    """
+    def __init__(self, registry, workers, max_queue=64, timeout=30.0):
+        self.bins_dir = registry.directory
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_queue)
+        self.lock = threading.Lock()
+        self.counters = {'completed': 0, 'failed': 0, 'rejected': 0, 'timeouts': 0, 'crashes': 0, 'recycled': 0}
+        self.builder = None
+        self.executor = None
+        self.jobs = itertools.count(1)
+        # executor -> its _RunningJobs
+        self.running = weakref.WeakKeyDictionary()
+        if workers:
+            self.executor = self._Executor()
+        else:
+            self.builder = Builder(registry)
+
+    def _Executor(self):
+        context = multiprocessing.get_context('spawn')
+        running = _RunningJobs(context, self.workers)
+        executor = concurrent.futures.ProcessPoolExecutor(
+            self.workers, context, initializer=_InitWorker, initargs=(self.bins_dir, running))
+        self.running[executor] = running
+        # start all workers now instead of on the first requests
+        for _ in range(self.workers):
+            executor.submit(_Ping)
+        return executor
+
+    def _Count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _Release(self, future):
+        self.slots.release()
+
+    def build(self, version, patches, comment, timer=None):
+        if not self.slots.acquire(blocking=False):
+            self._Count('rejected')
+            raise BackendBusy('Too many pending builds')
+
+        if self.executor is None:
+            try:
+                content = self.builder.build(version, patches, comment, timer)
+            except Exception:
+                self._Count('failed')
+                raise
+            finally:
+                self.slots.release()
+            self._Count('completed')
+            return content
+
+        executor = self.executor
+        with self.lock:
+            job = next(self.jobs)
+        start = time.perf_counter()
+        try:
+            future = executor.submit(_Build, job, version, patches, comment, timer is not None)
+        except BrokenProcessPool:
+            self.slots.release()
+            self._Replace(executor, 'crashes')
+            raise BackendBusy('Build worker crashed')
+        # the slot is only freed once the job really finished
+        future.add_done_callback(self._Release)
+
+        try:
+            content, stages = future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            self._Count('timeouts')
+            if not future.cancel():
+                # already in the pool's call queue or running
+                self._Watch(executor, future, job)
+            raise BackendBusy('Build timed out')
+        except BrokenProcessPool:
+            self._Replace(executor, 'crashes')
+            raise BackendBusy('Build worker crashed')
+        except Exception:
+            self._Count('failed')
+            raise
+        self._Count('completed')
+        if timer is not None:
+            # time spent waiting for a worker and transferring the job
+            timer.add('queue', time.perf_counter() - start - stages.pop('build'))
+            timer.update(stages)
+        return content
+
+    def _Watch(self, executor, future, job):
+        if future.done() or self.executor is not executor:
+            return
+        started = self.running[executor].started_at(job)
+        if started is None:
+            # not picked up by a worker yet
+            delay = self.timeout
+        else:
+            delay = started + self.timeout - time.monotonic()
+            if delay <= 0:
+                # its worker may never come back
+                self._Replace(executor, 'recycled', kill=True)
+                return
+        watch = threading.Timer(delay, self._Watch, (executor, future, job))
+        watch.daemon = True
+        watch.start()
+
+    def _Replace(self, executor, counter, kill=False):
+        with self.lock:
+            self.counters[counter] += 1
+            if self.executor is not executor:
+                return
+            self.executor = self._Executor()
+        # processes is only set while the pool is alive
+        processes = list((getattr(executor, '_processes', None) or {}).values())
+        executor.shutdown(wait=False, cancel_futures=kill)
+        if kill:
+            # shutdown() leaves running jobs alone, jobs of the other workers
+            # fail with BrokenProcessPool and report a crash
+            for process in processes:
+                process.terminate()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats['workers'] = self.workers
+        return stats
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,130 @@
+import collections
+import os
+import threading
+
+
+class BuildCache():
+    """Bounded LRU of finished builds, keyed by the hash of their parameters.
+
+    Entries evicted from memory are spilled to `directory` (if given) and
+    promoted back into memory on their next hit. The spilled entries are an
+    LRU of at most `max_disk_bytes` too, files are removed once they are
+    promoted or evicted from disk. Spills of earlier runs are adopted, which
+    is only safe because keys cover everything the content depends on (the
+    base image hash and the build format, see app.build_key); stale spills
+    are never hit and age out of the disk LRU.
+    """
+    def __init__(self, max_bytes=64 << 20, directory=None, max_disk_bytes=256 << 20):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # key -> size of the spilled entries, oldest first
+        self.disk = collections.OrderedDict()
+        self.disk_size = 0
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'spills': 0, 'disk_evictions': 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._Adopt()
+
+    def _Path(self, key):
+        return os.path.join(self.directory, key + '.zip')
+
+    def _Unlink(self, key):
+        try:
+            os.unlink(self._Path(key))
+        except FileNotFoundError:
+            pass
+
+    def _Adopt(self):
+        spilled = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.zip'):
+                st = os.stat(os.path.join(self.directory, name))
+                spilled.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(spilled):
+            self.disk[key] = size
+            self.disk_size += size
+        for key in self._TrimDisk():
+            self._Unlink(key)
+
+    def _TrimDisk(self):
+        # keys evicted from disk, called with the lock held
+        evicted = []
+        while self.disk_size > self.max_disk_bytes and self.disk:
+            key, size = self.disk.popitem(last=False)
+            self.disk_size -= size
+            self.counters['disk_evictions'] += 1
+            evicted.append(key)
+        return evicted
+
+    def get(self, key):
+        with self.lock:
+            content = self.entries.get(key)
+            if content is not None:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return content
+            size = self.disk.pop(key, None)
+            if size is not None:
+                self.disk_size -= size
+
+        if size is not None:
+            try:
+                with open(self._Path(key), 'rb') as fp:
+                    content = fp.read()
+            except FileNotFoundError:
+                content = None
+            # promoted back into memory, the file would only go stale
+            self._Unlink(key)
+            if content is not None:
+                with self.lock:
+                    self.counters['disk_hits'] += 1
+                self.put(key, content)
+                return content
+
+        with self.lock:
+            self.counters['misses'] += 1
+        return None
+
+    def put(self, key, content):
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = content
+            self.size += len(content)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old_key, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+                self.counters['evictions'] += 1
+                evicted.append((old_key, old))
+
+        if not self.directory:
+            return
+        for old_key, old in evicted:
+            if len(old) > self.max_disk_bytes:
+                continue
+            path = self._Path(old_key)
+            tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+            with open(tmp, 'wb') as fp:
+                fp.write(old)
+            os.replace(tmp, path)
+            with self.lock:
+                self.counters['spills'] += 1
+                self.disk_size += len(old) - self.disk.pop(old_key, 0)
+                self.disk[old_key] = len(old)
+                trimmed = self._TrimDisk()
+            for trimmed_key in trimmed:
+                self._Unlink(trimmed_key)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.size
+            stats['disk_entries'] = len(self.disk)
+            stats['disk_bytes'] = self.disk_size
+        return stats
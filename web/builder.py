@@ -0,0 +1,76 @@
+import os
+import io
+import zipfile
+import hashlib
+from patcher import FirmwarePatcher, SignatureIndex, DiffCache, FirmwareInfo
+from xiaotea import EncryptionCache
+from timing import Stage
+
+
+CHUNK_SIZE = 64 * 1024
+# part of every build key (and ETag), bump it whenever the patches or the zip
+# layout change the output for the same parameters
+BUILD_FORMAT = 1
+# fixed entry timestamps keep the zips reproducible
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+def _EntryInfo(name, compress_type):
+    info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+    info.compress_type = compress_type
+    info.external_attr = 0o600 << 16
+    return info
+
+def _WriteEntry(zip_file, name, data, compress_type):
+    # writes one zip entry and returns the MD5 of its data, in one pass
+    info = _EntryInfo(name, compress_type)
+    md5 = hashlib.md5()
+    view = memoryview(data)
+    with zip_file.open(info, 'w') as fp:
+        for i in range(0, len(view), CHUNK_SIZE):
+            chunk = view[i:i + CHUNK_SIZE]
+            md5.update(chunk)
+            fp.write(chunk)
+    return md5.hexdigest()
+
+def FirmwareZip(version, data, encrypted, comment):
+    """Zip of FIRM.bin, FIRM.bin.enc and info.txt. The images are hashed
+    while they are written, the ciphertext is stored as it doesn't compress."""
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED, False) as zip_file:
+        md5 = _WriteEntry(zip_file, 'FIRM.bin', data, zipfile.ZIP_DEFLATED)
+        md5e = _WriteEntry(zip_file, 'FIRM.bin.enc', encrypted, zipfile.ZIP_STORED)
+        zip_file.writestr(_EntryInfo('info.txt', zipfile.ZIP_DEFLATED), FirmwareInfo(version, md5, md5e).encode())
+        zip_file.comment = comment
+    return zip_buffer.getvalue()
+
+
+class Builder():
+    """Everything needed to build firmware, loaded once per process:
+    the base image registry, its signature index and the encryption/diff caches.
+
+    build() records its stages in `timer` if one is given."""
+    def __init__(self, registry):
+        self.registry = registry
+        self.index = SignatureIndex(os.path.join(registry.directory, 'signatures.json'))
+        for version in registry:
+            self.index.lookup(registry[version].data, registry[version].sha256)
+        self.encryption = EncryptionCache()
+        self.diffs = DiffCache()
+
+    def build(self, version, patches, comment, timer=None):
+        with Stage(timer, 'load'):
+            image = self.registry[version]
+            patcher = FirmwarePatcher(image.data, self.index, self.encryption, self.diffs, image.sha256, timer)
+
+        for name, args in patches:
+            getattr(patcher, name)(*args)
+
+        # the patched image is only assembled here
+        with Stage(timer, 'load'):
+            data = patcher.data.tobytes()
+        with Stage(timer, 'encrypt'):
+            patcher.encrypt()
+        with Stage(timer, 'zip'):
+            content = FirmwareZip(version, data, patcher.data, comment)
+
+        return content
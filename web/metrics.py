@@ -0,0 +1,49 @@
+import bisect
+import threading
+
+
+class StageMetrics():
+    """Histograms of build stage durations, rendered in the Prometheus
+    text format. patch.<method> stages go to a histogram per patch method,
+    everything else to one per stage."""
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # (metric, label name, label value) -> [bucket counts, sum, count]
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stages):
+        with self.lock:
+            for name, seconds in stages.items():
+                if name.startswith('patch.'):
+                    key = ('cfw_patch_seconds', 'method', name[6:])
+                else:
+                    key = ('cfw_stage_seconds', 'stage', name)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+                histogram[1] += seconds
+                histogram[2] += 1
+
+    def render(self):
+        helps = {'cfw_stage_seconds': 'Duration of the stages of /cfw requests.',
+                 'cfw_patch_seconds': 'Duration of the patch methods of /cfw builds.'}
+        lines = []
+        with self.lock:
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self.histograms.items())
+        for metric, help in sorted(helps.items()):
+            lines.append('# HELP {} {}'.format(metric, help))
+            lines.append('# TYPE {} histogram'.format(metric))
+            for (name, label, value), (counts, total, count) in histograms:
+                if name != metric:
+                    continue
+                cumulative = 0
+                for le, n in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += n
+                    lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(metric, label, value, le, cumulative))
+                lines.append('{}_sum{{{}="{}"}} {}'.format(metric, label, value, total))
+                lines.append('{}_count{{{}="{}"}} {}'.format(metric, label, value, count))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,115 @@
+import collections
+import threading
+import time
+from backend import BackendBusy
+
+# Query parameters of the presets, without the version, every preset is
+# offered for every version. home.html renders its preset buttons from these.
+PRESETS = collections.OrderedDict([
+    ('default', {}),
+    ('botox', {
+        'kers_min_speed': '40.0',
+        'speed_params': 'on', 'speed_normal_kmh': '31', 'speed_normal_phase': '60000', 'speed_normal_battery': '30000',
+        'speed_eco_kmh': '26', 'speed_eco_phase': '50000', 'speed_eco_battery': '20000',
+        'brake_params': 'on', 'brake_limit': '115', 'brake_i_min': '8000', 'brake_i_max': '50000',
+        'motor_start_speed': '3.0',
+        'instant_eco_switch': 'on',
+        'voltage_limit': '52.00',
+        'remove_hard_speed_limit': 'on',
+        'stay_on_locked': 'on',
+    }),
+    ('rollerplausch', {
+        'kers_min_speed': '40.0',
+        'speed_params': 'on', 'speed_normal_kmh': '30', 'speed_normal_phase': '50000', 'speed_normal_battery': '26500',
+        'speed_eco_kmh': '19', 'speed_eco_phase': '30000', 'speed_eco_battery': '15000',
+        'brake_params': 'on', 'brake_limit': '115', 'brake_i_min': '8000', 'brake_i_max': '45000',
+        'motor_start_speed': '3.0',
+        'instant_eco_switch': 'on',
+        'boot_with_eco': 'on',
+        'remove_hard_speed_limit': 'on',
+        'remove_charging_mode': 'on',
+        'stay_on_locked': 'on',
+    }),
+    ('dyoc', {
+        'voltage_limit': '52.00',
+    }),
+])
+
+# button labels on the home page
+PRESET_LABELS = {'default': 'Default', 'botox': 'BotoX', 'rollerplausch': 'Rollerplausch.com', 'dyoc': 'DYoC'}
+
+# form values a preset fills in without enabling their patch, only a starting
+# point for the user and not part of the preset build
+PRESET_FIELDS = {
+    'dyoc': {
+        'speed_normal_kmh': '31', 'speed_normal_phase': '41000', 'speed_normal_battery': '22000',
+        'speed_eco_kmh': '20', 'speed_eco_phase': '22000', 'speed_eco_battery': '9000',
+        'brake_i_max': '38500',
+    },
+}
+
+# a busy backend is asked again after RETRY_DELAY seconds, at most RETRIES times
+RETRIES = 10
+RETRY_DELAY = 10.0
+
+
+class PresetStore():
+    """Finished preset builds keyed by their build key, kept in memory for
+    the lifetime of the process and never evicted."""
+    def __init__(self):
+        self.builds = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counters = {'hits': 0, 'built': 0, 'failed': 0, 'retries': 0}
+
+    def get(self, key):
+        with self.lock:
+            content = self.builds.get(key)
+            if content is not None:
+                self.counters['hits'] += 1
+            return content
+
+    def put(self, key, content):
+        with self.lock:
+            self.builds[key] = content
+
+    def _Prebuild(self, jobs, build):
+        for key, args in jobs:
+            if key in self.builds:
+                continue
+            try:
+                self.put(key, self._Build(build, args))
+            except Exception:
+                # e.g. a patch the version doesn't support
+                with self.lock:
+                    self.counters['failed'] += 1
+                continue
+            with self.lock:
+                self.counters['built'] += 1
+
+    def _Build(self, build, args):
+        for _ in range(RETRIES):
+            try:
+                return build(*args)
+            except BackendBusy:
+                # the requests come first, try again once they are done
+                with self.lock:
+                    self.counters['retries'] += 1
+                time.sleep(RETRY_DELAY)
+        return build(*args)
+
+    def prebuild(self, jobs, build):
+        """Runs build(*args) for every (key, args) of jobs in a background
+        thread, one build at a time to leave the backend to the requests."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._Prebuild, args=(list(jobs), build), daemon=True)
+        self.thread.start()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.builds)
+            stats['prebuilding'] = self.thread is not None and self.thread.is_alive()
+        return stats
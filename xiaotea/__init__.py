@@ -1 +1 @@
-from .xiaotea import XiaoTea
\ No newline at end of file
+from .xiaotea import XiaoTea, XiaoTeaEncryptor, XiaoTeaDecryptor, CachedEncryption, EncryptionCache
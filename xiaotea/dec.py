@@ -1,7 +1,9 @@
 #!/usr/bin/python
 from sys import argv, exit
 from os.path import getsize
-from xiaotea import XiaoTea
+from xiaotea import XiaoTeaDecryptor
+
+CHUNK_SIZE = 64 * 1024
 
 if len(argv) != 3:
     exit('Usage: ' + argv[0] + ' <infile> <outfile>')
@@ -11,12 +13,17 @@ fsize = getsize(argv[1])
 if fsize % 8:
     exit('Wrong input file size !')
 
-cry = XiaoTea()
+cry = XiaoTeaDecryptor()
 
 hfi = open(argv[1], 'rb')
 hfo = open(argv[2], 'wb')
 
-hfo.write(cry.decrypt(hfi.read()))
+while True:
+    chunk = hfi.read(CHUNK_SIZE)
+    if not chunk:
+        break
+    hfo.write(cry.update(chunk))
+hfo.write(cry.finalize())
 
 hfo.close()
 hfi.close()
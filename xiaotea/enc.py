@@ -1,17 +1,23 @@
 #!/usr/bin/python
 from sys import argv, exit
-from os.path import getsize
-from xiaotea import XiaoTea
+from xiaotea import XiaoTeaEncryptor
+
+CHUNK_SIZE = 64 * 1024
 
 if len(argv) != 3:
     exit('Usage: ' + argv[0] + ' <infile> <outfile>')
 
-cry = XiaoTea()
+cry = XiaoTeaEncryptor()
 
 hfi = open(argv[1], 'rb')
 hfo = open(argv[2], 'wb')
 
-hfo.write(cry.encrypt(hfi.read()))
+while True:
+    chunk = hfi.read(CHUNK_SIZE)
+    if not chunk:
+        break
+    hfo.write(cry.update(chunk))
+hfo.write(cry.finalize())
 
 hfo.close()
 hfi.close()
@@ -1,8 +1,20 @@
 #!/usr/bin/python
 # Taken from https://electro.club/f/50300 and modified a bit
-from struct import pack, unpack
+from hashlib import sha256
+from struct import calcsize, iter_unpack, pack, pack_into, unpack, unpack_from
+from sys import byteorder
+from threading import Lock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 UPDKEY = b'\xFE\x80\x1C\xB2\xD1\xEF\x41\xA6\xA4\x17\x31\xF5\xA0\x68\x24\xF0'
+DELTA = 0x9E3779B9
+SUMS = tuple((DELTA * i) & 0xFFFFFFFF for i in range(1, 33))
+# words per numpy sum in word_sum
+SUM_CHUNK = 1024
 
 def tea_encrypt_ecb(block, key):
     y, z = unpack('<LL', block)
@@ -15,6 +27,92 @@ def tea_encrypt_ecb(block, key):
         z = (z + (((y << 4) + k[2]) ^ (y + s) ^ ((y >> 5) + k[3]))) & 0xFFFFFFFF
     return pack('<LL', y, z)
 
+def update_key(key, count=1):
+    # Every key update adds i to the i-th key byte
+    return bytes((key[i] + count * i) & 0xFF for i in range(16))
+
+def key_schedule(key, offset, size):
+    # TEA keys (as 4 words) for every 1KB key epoch touched by [offset, offset + size)
+    epochs = (offset + size - 1) // 1024 - offset // 1024 + 1 if size else 0
+    return [unpack('<LLLL', update_key(key, i)) for i in range(epochs)]
+
+def tea_encrypt_cbc(data, key, iv, offset=0):
+    # Encrypts 8 byte aligned data in one go, key epochs are precomputed and
+    # the CBC state is kept as integers. Returns (ciphertext, last block).
+    assert len(data) % 8 == 0, 'data must be 8 byte aligned!'
+    n = len(data) // 4
+    words = unpack('<{}L'.format(n), data)
+    out = [0] * n
+    y, z = unpack('<LL', iv)
+
+    start, end = 0, min(n, (1024 - offset % 1024) // 4)
+    for k0, k1, k2, k3 in key_schedule(key, offset, len(data)):
+        for i in range(start, end, 2):
+            y ^= words[i]
+            z ^= words[i + 1]
+            for s in SUMS:
+                y = (y + (((z << 4) + k0) ^ (z + s) ^ ((z >> 5) + k1))) & 0xFFFFFFFF
+                z = (z + (((y << 4) + k2) ^ (y + s) ^ ((y >> 5) + k3))) & 0xFFFFFFFF
+            out[i] = y
+            out[i + 1] = z
+        start, end = end, min(n, end + 256)
+
+    res = bytearray(len(data))
+    pack_into('<{}L'.format(n), res, 0, *out)
+    return res, pack('<LL', y, z)
+
+def tea_decrypt_cbc(data, key, iv, offset=0):
+    # Scalar counterpart of tea_encrypt_cbc. Returns (plaintext, last block).
+    assert len(data) % 8 == 0, 'data must be 8 byte aligned!'
+    n = len(data) // 4
+    words = unpack('<{}L'.format(n), data)
+    out = [0] * n
+    py, pz = unpack('<LL', iv)
+    rsums = SUMS[::-1]
+
+    start, end = 0, min(n, (1024 - offset % 1024) // 4)
+    for k0, k1, k2, k3 in key_schedule(key, offset, len(data)):
+        for i in range(start, end, 2):
+            cy, cz = y, z = words[i], words[i + 1]
+            for s in rsums:
+                z = (z - (((y << 4) + k2) ^ (y + s) ^ ((y >> 5) + k3))) & 0xFFFFFFFF
+                y = (y - (((z << 4) + k0) ^ (z + s) ^ ((z >> 5) + k1))) & 0xFFFFFFFF
+            out[i] = y ^ py
+            out[i + 1] = z ^ pz
+            py, pz = cy, cz
+        start, end = end, min(n, end + 256)
+
+    res = bytearray(len(data))
+    pack_into('<{}L'.format(n), res, 0, *out)
+    return res, pack('<LL', py, pz)
+
+def tea_decrypt_cbc_numpy(data, key, iv, offset=0):
+    # CBC decryption has no serial dependency, so all blocks are decrypted at
+    # once as uint32 arrays and then XORed with the previous ciphertext block.
+    assert len(data) % 8 == 0, 'data must be 8 byte aligned!'
+    if not data:
+        return bytearray(), bytes(iv)
+    ct = numpy.frombuffer(bytes(data), dtype='<u4').reshape(-1, 2)
+    nblocks = len(ct)
+
+    keys = numpy.array(key_schedule(key, offset, len(data)), dtype=numpy.uint32)
+    epoch = (offset + 8 * numpy.arange(nblocks)) // 1024 - offset // 1024
+    k0, k1, k2, k3 = keys[epoch].T
+
+    y = ct[:, 0].astype(numpy.uint32)
+    z = ct[:, 1].astype(numpy.uint32)
+    for s in SUMS[::-1]:
+        s = numpy.uint32(s)
+        z -= ((y << 4) + k2) ^ (y + s) ^ ((y >> 5) + k3)
+        y -= ((z << 4) + k0) ^ (z + s) ^ ((z >> 5) + k1)
+
+    pt = numpy.empty((nblocks, 2), dtype='<u4')
+    pt[0] = numpy.frombuffer(bytes(iv), dtype='<u4')
+    pt[1:] = ct[:-1]
+    pt[:, 0] ^= y
+    pt[:, 1] ^= z
+    return bytearray(pt.tobytes()), ct[-1].tobytes()
+
 def tea_decrypt_ecb(block, key):
     y, z = unpack('<LL', block)
     k = unpack('<LLLL', key)
@@ -32,69 +130,204 @@ def xor(s1, s2):
         res.append(s1[i] ^ s2[i])
     return res
 
-def checksum(data):
-    s = 0
-    for i in range(0, len(data), 4):
-        s += unpack('<L', data[i:i+4])[0]
+def fold_checksum(s):
+    # Turns a sum of little endian words into the checksum
     return (((s >> 16) & 0xFFFF) | ((s & 0xFFFF) << 16)) ^ 0xFFFFFFFF
 
+def word_sum(data):
+    # Sum of the little endian words of 4 byte aligned data, without copying it
+    assert len(data) % 4 == 0, 'data must be 4 byte aligned!'
+    with memoryview(data) as view, view.cast('B') as octets:
+        if numpy is not None:
+            # in chunks, numpy widens the words in a buffer as large as its input
+            words = numpy.frombuffer(octets, dtype='<u4')
+            return sum(int(words[i:i + SUM_CHUNK].sum(dtype=numpy.uint64)) for i in range(0, len(words), SUM_CHUNK))
+        if byteorder == 'little' and calcsize('I') == 4:
+            with octets.cast('I') as words:
+                return sum(words)
+        return sum(word for word, in iter_unpack('<L', octets))
+
+def checksum(data):
+    return fold_checksum(word_sum(data))
+
 def pad(data):
     # The data which will be encrypted must be 8 byte aligned!
     # We also have to write a checksum to the last 4 bytes.
-    # Zero pad for 4-byte aligning first:
-    sz = len(data)
-    if sz % 4:
-        o = (4 - (sz % 4))
-        data += b'\x00' * o
-        sz += o
-
-    # If we're 8-byte aligned now then add 4 zero pad bytes
-    if (sz % 8) == 0:
-        data += b'\x00\x00\x00\x00'
+    # Zero pad for 4-byte aligning first, if we're 8-byte aligned then add
+    # 4 zero pad bytes so we can add our 4 checksum bytes and be 8-byte aligned.
+    # Returns a new buffer, data is copied into it exactly once.
+    sz = (len(data) + 3) & ~3
+    if sz % 8 == 0:
+        sz += 4
+    res = bytearray(sz + 4)
+    with memoryview(res) as view:
+        # unlike bytearray slice assignment this doesn't copy data first
+        view[:len(data)] = data
+        pack_into('<L', res, sz, checksum(view[:sz]))
+    return res
 
-    # so we can add our 4 checksum bytes and be 8-byte aligned
-    return data + pack('<L', checksum(data))
+def verify_checksum(data):
+    with memoryview(data) as view:
+        chk, = unpack_from('<L', view, len(view) - 4)
+        assert checksum(view[:-4]) == chk, 'checksum does not match!'
 
 def unpad(data):
-    chk = unpack('<L', data[-4:])[0]
-    s = checksum(data[:-4])
-    assert s == chk, 'checksum does not match!'
+    verify_checksum(data)
     return data[:-4]
 
-
 class XiaoTea:
     def __init__(self):
         self.key = UPDKEY
         self.iv = b'\x00' * 8
         self.offset = 0
 
-    def _UpdateKey(self):
-        k = bytearray()
-        for i in range(16):
-            k.append((self.key[i] + i) & 0xFF)
-        self.key = k
+    def _UpdateKey(self, count=1):
+        self.key = update_key(self.key, count)
+
+    def _Advance(self, size):
+        self._UpdateKey((self.offset + size) // 1024 - self.offset // 1024)
+        self.offset += size
+
+    def _EncryptBlocks(self, data):
+        res, self.iv = tea_encrypt_cbc(data, self.key, self.iv, self.offset)
+        self._Advance(len(data))
+        return res
+
+    def _DecryptBlocks(self, data):
+        decrypt_cbc = tea_decrypt_cbc if numpy is None else tea_decrypt_cbc_numpy
+        res, self.iv = decrypt_cbc(data, self.key, self.iv, self.offset)
+        self._Advance(len(data))
+        return res
 
     def encrypt(self, data):
         data = pad(data)
         assert len(data) % 8 == 0, 'data must be 8 byte aligned!'
-        res = bytearray()
-        for i in range(0, len(data), 8):
-            ct = tea_encrypt_ecb(xor(self.iv, data[i:i+8]), self.key)
-            res += ct
-            self.iv = ct
-            self.offset += 8
-            if (self.offset % 1024) == 0:
-                self._UpdateKey()
-        return res
+        return self._EncryptBlocks(data)
 
     def decrypt(self, data):
         assert len(data) % 8 == 0, 'data must be 8 byte aligned!'
-        res = bytearray()
-        for i in range(0, len(data), 8):
-            ct = data[i:i+8]
-            res += xor(self.iv, tea_decrypt_ecb(ct, self.key))
-            self.iv = ct
-            self.offset += 8
-            if (self.offset % 1024) == 0:
-                self._UpdateKey()
-        return unpad(res)
+        # the plaintext is ours, strip the checksum in place
+        res = self._DecryptBlocks(data)
+        verify_checksum(res)
+        del res[-4:]
+        return res
+
+
+class XiaoTeaEncryptor:
+    """Incremental XiaoTea.encrypt
+
+    Feed the plaintext in arbitrarily sized chunks with update(), every call
+    returns the ciphertext of all complete blocks so far. finalize() pads the
+    tail, appends the checksum and returns the last blocks. The concatenated
+    output is identical to XiaoTea().encrypt(data).
+    """
+    def __init__(self):
+        self.tea = XiaoTea()
+        self.buf = bytearray()
+        self.sum = 0
+
+    def update(self, chunk):
+        self.buf += chunk
+        n = len(self.buf) & ~7
+        if not n:
+            return bytearray()
+        blocks = self.buf[:n]
+        del self.buf[:n]
+        self.sum += word_sum(blocks)
+        return self.tea._EncryptBlocks(blocks)
+
+    def finalize(self):
+        tail = pad(self.buf)
+        self.buf = bytearray()
+        # pad() only knows about the tail, fix up its checksum
+        with memoryview(tail) as view:
+            s = self.sum + word_sum(view[:-4])
+        pack_into('<L', tail, len(tail) - 4, fold_checksum(s))
+        return self.tea._EncryptBlocks(tail)
+
+
+class XiaoTeaDecryptor:
+    """Incremental XiaoTea.decrypt
+
+    The last 4 plaintext bytes are the checksum, so the last decrypted block
+    is held back until finalize(), which verifies the checksum. The
+    concatenated output is identical to XiaoTea().decrypt(data).
+    """
+    def __init__(self):
+        self.tea = XiaoTea()
+        self.buf = bytearray()
+        self.last = bytearray()
+        self.sum = 0
+
+    def update(self, chunk):
+        self.buf += chunk
+        n = len(self.buf) & ~7
+        if not n:
+            return bytearray()
+        blocks = self.buf[:n]
+        del self.buf[:n]
+        res = self.last + self.tea._DecryptBlocks(blocks)
+        self.last = res[-8:]
+        del res[-8:]
+        self.sum += word_sum(res)
+        return res
+
+    def finalize(self):
+        assert not self.buf, 'data must be 8 byte aligned!'
+        assert self.last, 'no data'
+        s, chk = unpack('<LL', self.last)
+        assert fold_checksum(self.sum + s) == chk, 'checksum does not match!'
+        return bytearray(self.last[:4])
+
+
+class CachedEncryption:
+    """Encrypted base image for re-encrypting patched copies of it
+
+    With CBC every ciphertext block before the first modified plaintext block
+    is the same as in the base image. The CBC state at any block boundary is
+    the previous ciphertext block and the key epoch follows from the offset,
+    so only the tail starting at the first patched block (the lowest offset of
+    the (ofs, pre, post) patch triples) is encrypted again.
+    """
+    def __init__(self, data):
+        self.plaintext = bytes(data)
+        self.ciphertext = bytes(XiaoTea().encrypt(data))
+
+    def encrypt(self, data, changes):
+        assert len(data) == len(self.plaintext), 'patched image must be as large as the base image'
+        start = min((ofs for ofs, pre, post in changes), default=len(data)) & ~7
+
+        # changes before start which weren't reported would corrupt the output
+        view = memoryview(data)
+        if not self.plaintext.startswith(view[:start]):
+            return XiaoTea().encrypt(data)
+
+        # the checksum covers the whole image, not only the reported changes
+        tail = pad(view[start:])
+        aligned = len(data) & ~3
+        s = word_sum(view[:aligned]) + int.from_bytes(view[aligned:], 'little')
+        pack_into('<L', tail, len(tail) - 4, fold_checksum(s))
+        iv = self.ciphertext[start - 8:start] if start else b'\x00' * 8
+        ct, _ = tea_encrypt_cbc(tail, update_key(UPDKEY, start // 1024), iv, start)
+
+        res = bytearray(self.ciphertext[:start])
+        res += ct
+        return res
+
+
+class EncryptionCache:
+    """CachedEncryption of every base image seen, keyed by SHA-256"""
+    def __init__(self):
+        self.images = {}
+        self.lock = Lock()
+
+    def lookup(self, data, digest=None):
+        if digest is None:
+            digest = sha256(data).hexdigest()
+        with self.lock:
+            cached = self.images.get(digest)
+        if cached is None:
+            cached = CachedEncryption(data)
+            with self.lock:
+                self.images[digest] = cached
+        return cached